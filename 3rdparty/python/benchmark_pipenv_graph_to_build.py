@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Times every stage of BUILD generation on synthetic graphs
+
+Results can be saved as a JSON baseline and later runs compared against it,
+failing when any stage got slower or hungrier than the allowed threshold.
+"""
+import json
+import logging
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+try:
+    from .pipenv_graph_to_build import (
+        EMITTERS,
+        TARGET_FORMATS,
+        DependencyGraph,
+        analyze_graph,
+        create_build_file,
+        main,
+        read_dependencies,
+        read_direct_dependencies,
+        sort_graph_file,
+    )
+except ImportError:
+    from pipenv_graph_to_build import (
+        EMITTERS,
+        TARGET_FORMATS,
+        DependencyGraph,
+        analyze_graph,
+        create_build_file,
+        main,
+        read_dependencies,
+        read_direct_dependencies,
+        sort_graph_file,
+    )
+
+DEFAULT_SCENARIOS = ("chain:1000", "fanout:10000", "diamond:1000", "cycles:1000", "forest:10000")
+
+
+def _key(i: int) -> str:
+    return f"package-{i:05}"
+
+
+def _chain(size: int, r: random.Random) -> List[List[int]]:
+    return [[i + 1] if i + 1 < size else [] for i in range(size)]
+
+
+def _fanout(size: int, r: random.Random) -> List[List[int]]:
+    return [list(range(1, size))] + [[] for _ in range(1, size)]
+
+
+def _diamond(size: int, r: random.Random, width: int = 10) -> List[List[int]]:
+    """Layers of width packages where every package depends on the whole next layer"""
+    return [list(range((i // width + 1) * width, min(size, (i // width + 2) * width))) for i in range(size)]
+
+
+def _cycles(size: int, r: random.Random, length: int = 10) -> List[List[int]]:
+    """A chain where every block of length packages also loops back on itself"""
+    edges = _chain(size, r)
+    for start in range(0, size, length):
+        end = min(size, start + length) - 1
+        if end > start:
+            edges[end].append(start)
+
+    return edges
+
+
+def _forest(size: int, r: random.Random) -> List[List[int]]:
+    """Looks like a real environment, many packages sharing a small core of common dependencies"""
+    core = max(1, size // 20)
+    edges = [r.sample(range(i + 1, core), min(2, core - i - 1)) for i in range(core)]
+    edges.extend(r.sample(range(core), min(core, r.randint(1, 4))) for _ in range(core, size))
+    return edges
+
+
+SHAPES: Dict[str, Callable[[int, random.Random], List[List[int]]]] = dict(
+    chain=_chain, fanout=_fanout, diamond=_diamond, cycles=_cycles, forest=_forest
+)
+
+
+def synthetic_graph(shape: str, size: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Graph json-tree entries in the format pipenv graph --json produces"""
+    edges = SHAPES[shape](size, random.Random(seed))
+    return [
+        dict(
+            package=dict(key=_key(i), package_name=_key(i), installed_version=f"1.0.{i}"),
+            dependencies=[
+                dict(key=_key(j), package_name=_key(j), installed_version=f"1.0.{j}", required_version="Any")
+                for j in edges[i]
+            ],
+        )
+        for i in range(size)
+    ]
+
+
+def synthetic_pipfile(packages: List[Dict[str, Any]], direct: int = 40) -> str:
+    """A Pipfile declaring direct packages spread evenly over the graph"""
+    step = max(1, len(packages) // direct)
+    keys = [p["package"]["key"] for p in packages[::step][:direct]]
+    return "[packages]\n" + "".join(f'{key} = "*"\n' for key in keys)
+
+
+def _measure(f: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return dict(seconds=min(seconds), peak_bytes=peak)
+
+
+def run_scenario(shape: str, size: int, directory: Path, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    packages = synthetic_graph(shape, size)
+    pipfile = directory / "Pipfile"
+    pipfile_graph = directory / "Pipfile.lock.graph"
+    unsorted_graph = directory / "Pipfile.lock.graph.unsorted"
+    build_file = directory / "BUILD"
+    pipfile.write_text(synthetic_pipfile(packages))
+    unsorted_graph.write_text(json.dumps(packages[::-1]))
+    pipfile_graph.write_text(json.dumps(packages, indent=4))
+
+    graph_text = pipfile_graph.read_text()
+    pipfile_text = pipfile.read_text()
+    all_dependencies = list(read_dependencies(graph_text))
+    direct_dependencies = read_direct_dependencies(pipfile_text)
+
+    resolved = [d for d in all_dependencies if d.key in direct_dependencies]
+    outputs = [(name, directory / name) for name in EMITTERS if name != "build"]
+
+    def sort_graph() -> None:
+        shutil.copyfile(str(unsorted_graph), str(pipfile_graph))
+        sort_graph_file(pipfile_graph)
+
+    stages: List[Tuple[str, Callable[[], Any]]] = [
+        ("read_dependencies", lambda: list(read_dependencies(graph_text))),
+        ("read_direct_dependencies", lambda: read_direct_dependencies(pipfile_text)),
+        ("create_build_file", lambda: create_build_file(all_dependencies, direct_dependencies)),
+        ("sort_graph", sort_graph),
+        ("main", lambda: main(pipfile, pipfile_graph, build_file)),
+        *((f"emit_{name}", lambda e=e: "".join(e().chunks(resolved))) for name, e in EMITTERS.items()),
+        ("main_every_format", lambda: main(pipfile, pipfile_graph, build_file, outputs=outputs)),
+        ("analytics", lambda: analyze_graph(DependencyGraph.from_json(graph_text), direct_dependencies)),
+    ]
+    return {name: _measure(f, repeat) for name, f in stages}
+
+
+def render_throughput(shape: str, size: int, repeat: int = 3) -> Dict[str, float]:
+    """Targets rendered per second when every package in the graph gets a target, per target format"""
+    all_dependencies = list(read_dependencies(json.dumps(synthetic_graph(shape, size))))
+    throughput = dict()
+    for target_format in TARGET_FORMATS:
+        seconds = _measure(lambda: create_build_file(all_dependencies, target_format=target_format), repeat)["seconds"]
+        throughput[target_format] = len(all_dependencies) / seconds
+
+    return throughput
+
+
+def import_time(module: str = "pipenv_graph_to_build", repeat: int = 3) -> Dict[str, float]:
+    """Cumulative import time of module in a fresh interpreter as python -X importtime reports it"""
+    seconds = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=str(Path(__file__).parent),
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        seconds.append(_cumulative_import_time(process.stderr, module))
+
+    return dict(seconds=min(seconds))
+
+
+def _cumulative_import_time(importtime_output: str, module: str) -> float:
+    for line in importtime_output.splitlines():
+        # nested imports are indented further, the module itself is the top level line
+        if line.startswith("import time:") and line.endswith(f"| {module}"):
+            return int(line.split("|")[1]) / 1e6
+
+    raise ValueError(f"{module} is missing from the -X importtime output")
+
+
+def find_regressions(
+    baseline: Dict[str, Dict[str, Dict[str, float]]],
+    results: Dict[str, Dict[str, Dict[str, float]]],
+    threshold: float,
+) -> List[str]:
+    """Every measurement that grew by more than threshold (0.25 is 25%) compared to the baseline"""
+    regressions = []
+    for scenario, stages in sorted(results.items()):
+        for stage, measurements in sorted(stages.items()):
+            for metric, value in sorted(measurements.items()):
+                previous = baseline.get(scenario, {}).get(stage, {}).get(metric)
+                if previous and value > previous * (1 + threshold):
+                    regressions.append(
+                        f"{scenario} {stage} {metric}: {value:.6g} is {value / previous - 1:.0%} above {previous:.6g}"
+                    )
+
+    return regressions
+
+
+def _print_table(results: Dict[str, Dict[str, Dict[str, float]]]) -> None:
+    print(f"{'scenario':<16}{'stage':<28}{'seconds':>12}{'peak MiB':>12}")
+    for scenario, stages in results.items():
+        for stage, measurements in stages.items():
+            peak = f"{measurements['peak_bytes'] / (1 << 20):>12.2f}" if "peak_bytes" in measurements else ""
+            print(f"{scenario:<16}{stage:<28}{measurements['seconds']:>12.4f}{peak}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        help=f"shape:size, any of {', '.join(SHAPES)}. Defaults to {' '.join(DEFAULT_SCENARIOS)}",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Best wall time of this many runs is kept")
+    parser.add_argument("--baseline", help="Fail if results regress compared to this baseline JSON")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed growth over the baseline")
+    parser.add_argument("--save-baseline", help="Write results to this JSON file")
+    parser.add_argument(
+        "--render-throughput",
+        action="store_true",
+        help="Also print targets rendered per second for every target format",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Also measure the import time of pipenv_graph_to_build in a fresh interpreter (python 3.7+)",
+    )
+
+    args = parser.parse_args()
+    # the cycles scenario would otherwise log every cycle on every run
+    logging.disable(logging.WARNING)
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for scenario in args.scenario or DEFAULT_SCENARIOS:
+            shape, size = scenario.split(":")
+            results[scenario] = run_scenario(shape, int(size), Path(directory), args.repeat)
+    if args.startup:
+        results["startup"] = dict(import_pipenv_graph_to_build=import_time(repeat=args.repeat))
+
+    _print_table(results)
+
+    if args.render_throughput:
+        print(f"\n{'scenario':<16}{'format':<28}{'targets/s':>12}")
+        for scenario in args.scenario or DEFAULT_SCENARIOS:
+            shape, size = scenario.split(":")
+            for target_format, targets_per_second in render_throughput(shape, int(size), args.repeat).items():
+                print(f"{scenario:<16}{target_format:<28}{targets_per_second:>12.0f}")
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=4, sort_keys=True))
+
+    if args.baseline:
+        regressions = find_regressions(json.loads(Path(args.baseline).read_text()), results, args.threshold)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
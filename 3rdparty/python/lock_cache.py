@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Content addressed cache of the files produced by the pipenv container
+
+Keyed on Pipfile, Pipfile.lock and the generator scripts, so a regeneration
+with unchanged inputs can restore Pipfile.lock.graph and BUILD without
+starting pipenv at all.
+"""
+import hashlib
+import json
+import shutil
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+INPUTS = ("Pipfile", "Pipfile.lock")
+OUTPUTS = ("Pipfile.lock", "Pipfile.lock.graph", "BUILD")
+GENERATORS = ("Dockerfile", "pipenv_graph_to_build.py", "sort_pipfile_lock_graph.py", "lock_cache.py")
+PENDING_KEY = ".lock-cache-key"
+
+
+def _file_hash(path: Path) -> Optional[str]:
+    if not path.exists():
+        return None
+
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def cache_key(directory: Path, generator_directory: Path = Path(__file__).parent) -> str:
+    """Hash of the pipenv inputs plus the scripts that turn them into BUILD"""
+    h = hashlib.sha256()
+    for name, path in [*((n, directory / n) for n in INPUTS), *((n, generator_directory / n) for n in GENERATORS)]:
+        h.update(f"{name}={_file_hash(path)}\n".encode())
+
+    return h.hexdigest()
+
+
+def store(directory: Path, cache_directory: Path, keys: Iterable[str]) -> List[Path]:
+    """Copies the outputs into one cache entry per key along with a manifest of their hashes"""
+    manifest = {name: _file_hash(directory / name) for name in OUTPUTS if (directory / name).exists()}
+    entries = []
+    for key in sorted(set(keys)):
+        entry = cache_directory / key
+        entry.mkdir(parents=True, exist_ok=True)
+        for name in manifest:
+            shutil.copyfile(str(directory / name), str(entry / name))
+        (entry / "manifest.json").write_text(json.dumps(manifest, indent=4, sort_keys=True))
+        entries.append(entry)
+
+    return entries
+
+
+def restore(directory: Path, cache_directory: Path, key: str) -> bool:
+    """Puts the cached outputs for key back in place, returns False on a miss"""
+    entry = cache_directory / key
+    manifest = _read_manifest(entry)
+    if manifest is None or _corrupt_files(entry, manifest):
+        return False
+
+    for name in manifest:
+        if _file_hash(directory / name) != manifest[name]:
+            shutil.copyfile(str(entry / name), str(directory / name))
+
+    return True
+
+
+def verify(directory: Path, cache_directory: Path, key: Optional[str] = None) -> List[str]:
+    """Lists everything that is inconsistent, the cache is fine if nothing is returned
+
+    Every entry has to match its manifest. When key is given and cached, the
+    outputs in directory also have to match that entry.
+    """
+    problems = []
+    entries = sorted(e for e in cache_directory.iterdir() if e.is_dir()) if cache_directory.is_dir() else []
+    for entry in entries:
+        manifest = _read_manifest(entry)
+        if manifest is None:
+            problems.append(f"{entry.name}: missing or unreadable manifest")
+            continue
+
+        problems.extend(f"{entry.name}: {name} does not match its manifest" for name in _corrupt_files(entry, manifest))
+
+    if key is not None and (cache_directory / key).is_dir():
+        manifest = _read_manifest(cache_directory / key) or {}
+        problems.extend(
+            f"{name} differs from the cached copy for the current inputs"
+            for name, digest in sorted(manifest.items())
+            if _file_hash(directory / name) != digest
+        )
+
+    return problems
+
+
+def _read_manifest(entry: Path) -> Optional[Dict[str, str]]:
+    try:
+        manifest = json.loads((entry / "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+    return manifest if isinstance(manifest, dict) else None
+
+
+def _corrupt_files(entry: Path, manifest: Dict[str, str]) -> List[str]:
+    return [name for name, digest in sorted(manifest.items()) if _file_hash(entry / name) != digest]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--directory", default=".", help="Where Pipfile and the generated files live")
+    parser.add_argument("--cache-directory", default="tmp/cache")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    subparsers.add_parser("key", help="Print the cache key of the current inputs")
+    subparsers.add_parser("restore", help="Restore outputs for the current inputs, exits 1 on a miss")
+    subparsers.add_parser("store", help="Store outputs for the current inputs and the ones seen at restore")
+    subparsers.add_parser("verify", help="Check cache entries against their manifests, exits 1 on problems")
+
+    args = parser.parse_args()
+    directory = Path(args.directory)
+    cache_directory = Path(args.cache_directory)
+    pending = cache_directory / PENDING_KEY
+    key = cache_key(directory)
+
+    if args.command == "key":
+        print(key)
+    elif args.command == "restore":
+        if not restore(directory, cache_directory, key):
+            cache_directory.mkdir(parents=True, exist_ok=True)
+            pending.write_text(key)
+            print(f"Cache miss for {key}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Restored {', '.join(OUTPUTS)} from cache {key}", file=sys.stderr)
+    elif args.command == "store":
+        # pipenv install can rewrite Pipfile.lock, so the outputs are stored under the
+        # key of the inputs before the container ran as well as the one after it
+        keys = [key, pending.read_text().strip()] if pending.exists() else [key]
+        store(directory, cache_directory, keys)
+        if pending.exists():
+            pending.unlink()
+    elif args.command == "verify":
+        problems = verify(directory, cache_directory, key)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
@@ -1,22 +1,60 @@
 #!/usr/bin/env python3
 import json
-import textwrap
-from argparse import ArgumentParser
-from itertools import chain
+import os
+import re
+import stat
+import sys
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, Union
 
-import toml
-from attr import Factory, attrib, attrs
+if TYPE_CHECKING:
+    import logging
+    import mmap
+
+# Modules only some paths need are imported where they're used, importing this one is most of a small regeneration
+
+
+def _logger() -> "logging.Logger":
+    import logging
+
+    return logging.getLogger(__name__)
 
 
-@attrs(slots=True, frozen=True)
 class Dependency:
-    key: str = attrib()
-    package_name: str = attrib()
-    installed_version: str = attrib()
+    """A pinned package and the packages it pulls in, compared and hashed by value
+
+    A slotted class rather than an attrs one, so importing this module
+    doesn't pay for importing attrs. Instances are never changed once made.
+    """
+
+    __slots__ = ("key", "package_name", "installed_version", "dependencies")
+
+    def __init__(
+        self, key: str, package_name: str, installed_version: str, dependencies: Iterable["Dependency"] = ()
+    ) -> None:
+        self.key = key
+        self.package_name = package_name
+        self.installed_version = installed_version
+        self.dependencies: Tuple["Dependency", ...] = tuple(dependencies)
 
-    dependencies: List["Dependency"] = attrib(default=Factory(list))
+    def _fields(self) -> Tuple[str, str, str, Tuple["Dependency", ...]]:
+        return self.key, self.package_name, self.installed_version, self.dependencies
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Dependency):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self) -> int:
+        return hash(self._fields())
+
+    def __repr__(self) -> str:
+        return (
+            f"Dependency(key={self.key!r}, package_name={self.package_name!r}, "
+            f"installed_version={self.installed_version!r}, dependencies={self.dependencies!r})"
+        )
 
     def __iter__(self) -> Iterable["Dependency"]:
         yield self
@@ -30,66 +68,969 @@ def apply(data: Iterable[Any], functions: Iterable[Callable[[Any], Any]]) -> Ite
     yield from data
 
 
-def read_dependencies(json_string: str) -> Iterable[Dependency]:
+def read_dependencies(json_string: str, backend: str = "auto") -> Iterable[Dependency]:
     """Reads out flattened dependencies per key from graph json-tree"""
-    dependencies = dict()
-    for d in sorted(json.loads(json_string), key=lambda x: x["package"]["key"]):
+    yield from DependencyGraph.from_json(json_string, backend).dependencies()
+
+
+def _index_packages(packages: Iterable[Dict[str, Any]]) -> Tuple[List[Dependency], List[List[int]]]:
+    """Turns graph json-tree entries into nodes sorted by key and adjacency lists of node indices
+
+    Entries are consumed one at a time and only the fields we need are kept,
+    so packages can be a stream. When keys collide the entry with the highest
+    raw key wins, exactly as if the entries had been sorted by key first.
+    """
+    dependencies: Dict[str, Tuple[Tuple[str, int], str, str, List[str]]] = dict()
+    stubs: Dict[str, Tuple[Tuple[str, int], str, str]] = dict()
+    for position, d in enumerate(packages):
         p = d["package"]
-        dependencies[p["key"].lower()] = dict(
-            key=p["key"].lower(),
-            package_name=p["package_name"].lower(),
-            installed_version=p["installed_version"],
-            dependencies=list(map(lambda x: x["key"], d["dependencies"])),
-        )
+        rank = (p["key"], position)
+        key = p["key"].lower()
+        if key not in dependencies or dependencies[key][0] <= rank:
+            dependencies[key] = (
+                rank,
+                p["package_name"].lower(),
+                p["installed_version"],
+                list(map(lambda x: x["key"].lower(), d["dependencies"])),
+            )
 
-        _fill_in_stub_dependencies(d, dependencies)
-
-    for d in sorted(dependencies.keys()):
-        d = dependencies[d]
-        yield Dependency(
-            d["key"].lower(),
-            d["package_name"].lower(),
-            d["installed_version"],
-            dependencies=list(
-                sorted(
-                    _dedupe_dependencies(
-                        chain.from_iterable(
-                            map(lambda x: _resolve_dependencies(x, dependencies), d["dependencies"])
-                        )
-                    ),
-                    key=lambda x: x.key,
-                )
-            ),
-        )
+        _fill_in_stub_dependencies(d, rank, stubs)
+
+    for key, (rank, package_name, installed_version) in stubs.items():
+        dependencies.setdefault(key, (rank, package_name, installed_version, []))
+
+    keys = list(sorted(dependencies.keys()))
+    positions = {key: i for i, key in enumerate(keys)}
+    nodes = [Dependency(*map(sys.intern, (key, *dependencies[key][1:3]))) for key in keys]
+    edges = [list(map(positions.__getitem__, dependencies[key][3])) for key in keys]
 
+    return nodes, edges
 
-def _fill_in_stub_dependencies(d, dependencies):
+
+def _fill_in_stub_dependencies(d, rank, stubs):
     """This is a special case because I've noticed that at least setuptools was missing"""
     for dd in d["dependencies"]:
-        if dd["key"].lower() in dependencies:
+        key = dd["key"].lower()
+        if key in stubs and stubs[key][0] <= rank:
             continue
 
-        dependencies[dd["key"].lower()] = dict(
-            key=dd["key"],
-            package_name=dd["package_name"],
-            installed_version=dd["installed_version"],
-            dependencies=[],
-        )
+        stubs[key] = (rank, dd["package_name"].lower(), dd["installed_version"])
 
 
-def _resolve_dependencies(dependency: str, dependencies: Dict[str, Dict[str, Any]]) -> Iterable[Dependency]:
-    d = dependencies[dependency.lower()]
-    yield Dependency(d["key"].lower(), d["package_name"].lower(), d["installed_version"])
-    for dd in d["dependencies"]:
-        yield from _resolve_dependencies(dd, dependencies)
+def iter_graph_packages(pipfile_graph: Path, chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """Yields the entries of a graph json-tree file one by one
+
+    Only one entry is decoded at a time so the full object tree is never
+    held in memory. Uses ijson when it's installed, otherwise the stdlib
+    decoder is run over a sliding window of the file.
+    """
+    try:
+        import ijson
+    except ImportError:
+        pass
+    else:
+        with pipfile_graph.open("rb") as f:
+            yield from ijson.items(f, "item")
+        return
+
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[\s,]*")
+    with pipfile_graph.open() as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"Expected a json list in {pipfile_graph}")
+
+        position = 1
+        eof = False
+        while True:
+            position = whitespace.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
 
+            try:
+                d, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = len(buffer)
+
+            if end == len(buffer) and not eof:
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
 
-def _dedupe_dependencies(dependencies: Iterable[Dependency]) -> Iterable[Dependency]:
-    keys_seen = set()
-    for d in dependencies:
-        if d.key not in keys_seen:
             yield d
-            keys_seen.add(d.key)
+            position = end
+
+
+def sort_graph_file(pipfile_graph: Path) -> List[Dict[str, Any]]:
+    """Sorts packages and their dependencies by key in place to keep diffs small
+
+    Returns the sorted entries so they can be indexed without parsing the
+    file a second time.
+    """
+    return write_graph_file(pipfile_graph, list(iter_graph_packages(pipfile_graph)))
+
+
+def write_graph_file(pipfile_graph: Path, packages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Writes graph json-tree entries sorted by key, the same way sort_pipfile_lock_graph.py always has"""
+    packages.sort(key=lambda obj: obj["package"]["key"])
+    for package in packages:
+        package["dependencies"].sort(key=lambda obj: obj["key"])
+
+    with pipfile_graph.open("w") as f:
+        json.dump(packages, f, indent=4)
+
+    return packages
+
+
+class GraphSnapshot:
+    """Binary copy of an indexed graph file, so an unchanged graph isn't parsed again
+
+    Holds the string table and the adjacency lists flattened into arrays of
+    node indices, read back through a memory map. A snapshot belongs to the
+    graph file with the content hash it recorded. The hash is only skipped
+    when the graph still has the recorded size, modification time and
+    change time, and last changed before the snapshot was written. The
+    change time catches rewrites that keep the old modification time, like
+    rsync -t or cp -p. A graph that changed in the same clock tick the
+    snapshot was written in can't be told apart by its stat, so it is hashed
+    too, like git does for racily clean files. After a hash match the
+    snapshot is saved again with the current stat. Anything else, including
+    snapshots written in another format version, is treated as a miss.
+    """
+
+    version = 2
+    magic = b"PGBS"
+    # magic, version, little endian, graph size, mtime and ctime, graph sha256, nodes, edges, string table bytes
+    _header_format = "<4sI?3xQQQ32sIIQ"
+
+    def __init__(self, path: Path, pipfile_graph: Path) -> None:
+        self.path = path
+        self.pipfile_graph = pipfile_graph
+        self.hit = False
+        self._rehashed: Optional[str] = None
+
+    @classmethod
+    def next_to(cls, pipfile_graph: Path) -> "GraphSnapshot":
+        return cls(pipfile_graph.with_name(f".{pipfile_graph.name}.snapshot"), pipfile_graph)
+
+    def index(self) -> Tuple[List[Dependency], List[List[int]]]:
+        """Nodes and edges of the graph file, from the snapshot when it's still valid"""
+        source = self.pipfile_graph.stat()
+        indexed = self._load(source)
+        self.hit = indexed is not None
+        if indexed is not None:
+            # a touched but unchanged graph is recorded again so the next load doesn't hash it
+            if self._rehashed is not None and _same_file(source, self.pipfile_graph.stat()):
+                self._save(*indexed, source, self._rehashed)
+            return indexed
+
+        digest = _file_digest(self.pipfile_graph)
+        nodes, edges = _index_packages(iter_graph_packages(self.pipfile_graph))
+        # a graph rewritten while it was parsed must not be recorded under the old content hash
+        if _same_file(source, self.pipfile_graph.stat()):
+            self._save(nodes, edges, source, digest)
+
+        return nodes, edges
+
+    def _load(self, source: os.stat_result) -> Optional[Tuple[List[Dependency], List[List[int]]]]:
+        import mmap
+        import struct
+
+        try:
+            with self.path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return self._read(m, source, os.fstat(f.fileno()).st_mtime_ns)
+        except (OSError, ValueError, struct.error, IndexError):
+            return None
+
+    def _read(
+        self, m: "mmap.mmap", source: os.stat_result, written_ns: int
+    ) -> Optional[Tuple[List[Dependency], List[List[int]]]]:
+        import struct
+        from array import array
+
+        header = struct.Struct(self._header_format)
+        values = header.unpack_from(m)
+        magic, version, little_endian, size, mtime_ns, ctime_ns, digest, n_nodes, n_edges, n_bytes = values
+        if (magic, version, little_endian) != (self.magic, self.version, sys.byteorder == "little"):
+            return None
+        self._rehashed = None
+        recorded = (size, mtime_ns, ctime_ns) == (source.st_size, source.st_mtime_ns, source.st_ctime_ns)
+        if not recorded or ctime_ns >= written_ns:
+            if digest.hex() != _file_digest(self.pipfile_graph):
+                return None
+            self._rehashed = digest.hex()
+
+        sections = [3 * n_nodes, n_nodes + 1, n_edges]
+        arrays = []
+        start = header.size
+        for length in sections:
+            arrays.append(array("I", m[start : start + 4 * length]).tolist())
+            start += 4 * length
+        if start + n_bytes != len(m):
+            return None
+
+        strings = [sys.intern(s) for s in m[start:].decode("utf-8").split("\0")]
+        fields, offsets, targets = arrays
+        nodes = [Dependency(*map(strings.__getitem__, fields[i : i + 3])) for i in range(0, len(fields), 3)]
+        edges = [targets[offsets[i] : offsets[i + 1]] for i in range(n_nodes)]
+        return nodes, edges
+
+    def _save(self, nodes: List[Dependency], edges: List[List[int]], source: os.stat_result, digest: str) -> None:
+        import struct
+        from array import array
+
+        table: Dict[str, int] = dict()
+        fields = array(
+            "I", (table.setdefault(s, len(table)) for n in nodes for s in (n.key, n.package_name, n.installed_version))
+        )
+        offsets = array("I", [0])
+        for e in edges:
+            offsets.append(offsets[-1] + len(e))
+        targets = array("I", (edge for e in edges for edge in e))
+        strings = "\0".join(table).encode("utf-8")
+        header = struct.pack(
+            self._header_format,
+            self.magic,
+            self.version,
+            sys.byteorder == "little",
+            source.st_size,
+            source.st_mtime_ns,
+            source.st_ctime_ns,
+            bytes.fromhex(digest),
+            len(nodes),
+            len(targets),
+            len(strings),
+        )
+        if not write_if_changed(self.path, [header, fields.tobytes(), offsets.tobytes(), targets.tobytes(), strings]):
+            # still newer than the graph it was just checked against, or the next load would hash it again
+            os.utime(str(self.path))
+
+
+def _same_file(before: os.stat_result, after: os.stat_result) -> bool:
+    return all(getattr(before, a) == getattr(after, a) for a in ("st_size", "st_mtime_ns", "st_ctime_ns"))
+
+
+def collect_graph(site_packages: Path, max_workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Builds graph json-tree entries from the distributions installed in site_packages
+
+    A stand-in for `pipenv graph --json` that reads METADATA directly, so
+    versions are kept exactly as installed (.post releases included). The
+    metadata of each distribution is read on a thread pool. Requirements on
+    distributions that aren't installed are left out.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    metadata = _import_metadata()
+    paths = [str(p) for p in _site_packages_directories(site_packages)]
+    with ThreadPoolExecutor(max_workers) as executor:
+        distributions = list(executor.map(_read_distribution, metadata.distributions(path=paths)))
+
+    installed: Dict[str, Tuple[str, str]] = dict()
+    for name, version, _ in distributions:
+        installed.setdefault(_canonical_name(name), (name, version))
+
+    packages = []
+    seen = set()
+    for name, version, requirements in distributions:
+        if _canonical_name(name) in seen:
+            continue
+        seen.add(_canonical_name(name))
+
+        dependencies: Dict[str, Dict[str, Any]] = dict()
+        for requirement, required_version in requirements:
+            if _canonical_name(requirement) not in installed:
+                continue
+            dependency_name, dependency_version = installed[_canonical_name(requirement)]
+            dependencies.setdefault(
+                _graph_key(dependency_name),
+                dict(
+                    key=_graph_key(dependency_name),
+                    package_name=dependency_name,
+                    installed_version=dependency_version,
+                    required_version=required_version or "Any",
+                ),
+            )
+
+        packages.append(
+            dict(
+                package=dict(key=_graph_key(name), package_name=name, installed_version=version),
+                dependencies=list(dependencies.values()),
+            )
+        )
+
+    return packages
+
+
+def _import_metadata() -> Any:
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        import importlib_metadata as metadata
+
+    return metadata
+
+
+def _site_packages_directories(site_packages: Path) -> List[Path]:
+    """Accepts a site-packages directory as well as the root of a virtualenv"""
+    directories = sorted(site_packages.glob("lib/python*/site-packages")) + sorted(
+        site_packages.glob("Lib/site-packages")
+    )
+    return directories or [site_packages]
+
+
+_REQUIREMENT = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*\(?([^;()]*)\)?\s*(?:;(.*))?$")
+
+
+def _read_distribution(distribution: Any) -> Tuple[str, str, List[Tuple[str, str]]]:
+    requirements = []
+    for requirement in distribution.requires or []:
+        match = _REQUIREMENT.match(requirement)
+        if match is None or not _marker_applies(match.group(3)):
+            continue
+        requirements.append((match.group(1), match.group(2).strip()))
+
+    return distribution.metadata["Name"], distribution.version, requirements
+
+
+def _marker_applies(marker: Optional[str]) -> bool:
+    """Evaluates environment markers when packaging is around, otherwise only drops extras"""
+    if not marker or not marker.strip():
+        return True
+
+    try:
+        from packaging.markers import Marker
+    except ImportError:
+        return "extra" not in marker
+
+    return Marker(marker).evaluate(dict(extra=""))
+
+
+def _canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _graph_key(name: str) -> str:
+    """The key pipenv graph uses, which keeps dots unlike canonical names"""
+    return re.sub(r"[^A-Za-z0-9.]+", "-", name).lower()
+
+
+class SetClosureBackend:
+    """Closures as frozensets of node indices, cheapest for small graphs"""
+
+    name = "set"
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def combine(self, members: Iterable[int], closures: Iterable[FrozenSet[int]]) -> FrozenSet[int]:
+        closure = set(members)
+        for c in closures:
+            closure.update(c)
+
+        return frozenset(closure)
+
+    def members(self, closure: FrozenSet[int]) -> List[int]:
+        return sorted(closure)
+
+    def count(self, closure: FrozenSet[int]) -> int:
+        return len(closure)
+
+
+class BitsetClosureBackend:
+    """Closures packed into arbitrary precision ints, one bit per node index"""
+
+    name = "bitset"
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def combine(self, members: Iterable[int], closures: Iterable[int]) -> int:
+        closure = 0
+        for i in members:
+            closure |= 1 << i
+        for c in closures:
+            closure |= c
+
+        return closure
+
+    def members(self, closure: int) -> List[int]:
+        bits = bin(closure)[:1:-1]
+        indices = []
+        i = bits.find("1")
+        while i != -1:
+            indices.append(i)
+            i = bits.find("1", i + 1)
+
+        return indices
+
+    def count(self, closure: int) -> int:
+        return bin(closure).count("1")
+
+
+class NumpyClosureBackend:
+    """Closures as packed boolean rows that are OR:ed together in one vectorized call"""
+
+    name = "numpy"
+
+    def __init__(self, size: int) -> None:
+        import numpy
+
+        self.numpy = numpy
+        self.size = size
+        self.width = (size + 7) // 8
+
+    def combine(self, members: Iterable[int], closures: Iterable[Any]) -> Any:
+        np = self.numpy
+        rows = list(closures)
+        closure = np.bitwise_or.reduce(rows, axis=0) if rows else np.zeros(self.width, dtype=np.uint8)
+        indices = np.fromiter(members, dtype=np.intp)
+        if indices.size:
+            np.bitwise_or.at(closure, indices >> 3, (0x80 >> (indices & 7)).astype(np.uint8))
+
+        return closure
+
+    def members(self, closure: Any) -> List[int]:
+        return self.numpy.flatnonzero(self.numpy.unpackbits(closure, count=self.size)).tolist()
+
+    def count(self, closure: Any) -> int:
+        return int(self.numpy.count_nonzero(self.numpy.unpackbits(closure)))
+
+
+CLOSURE_BACKENDS = {b.name: b for b in (SetClosureBackend, BitsetClosureBackend, NumpyClosureBackend)}
+BITSET_THRESHOLD = 1000
+NUMPY_THRESHOLD = 5000
+
+
+def create_closure_backend(name: str, size: int) -> Any:
+    """Picks a closure backend by name, or by graph size when name is auto"""
+    if name == "auto":
+        import importlib.util
+
+        if size >= NUMPY_THRESHOLD and importlib.util.find_spec("numpy") is not None:
+            name = "numpy"
+        elif size >= BITSET_THRESHOLD:
+            name = "bitset"
+        else:
+            name = "set"
+
+    try:
+        return CLOSURE_BACKENDS[name](size)
+    except KeyError:
+        raise ValueError(f"Unknown closure backend {name!r}, pick one of {', '.join(CLOSURE_BACKENDS)}")
+
+
+class ClosureCache:
+    """Closures shared between graphs
+
+    Entries are keyed by a hash over the versions and structure of the
+    subgraph a package reaches, so when another project's graph, or a new
+    version of the same graph, reaches the same subgraph its closure is
+    taken from here instead of being combined again. Closures are kept as
+    the keys of their members so they apply to graphs with other indices.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._closures: Dict[str, _CachedClosure] = dict()
+
+    def get(self, signature: str) -> Optional["_CachedClosure"]:
+        cached = self._closures.get(signature)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return cached
+
+    def put(self, signature: str, keys: Tuple[str, ...]) -> "_CachedClosure":
+        cached = self._closures[signature] = _CachedClosure(keys)
+        return cached
+
+    def retain(self, signatures: Iterable[str]) -> None:
+        """Drops every closure except the ones with these signatures"""
+        signatures = set(signatures)
+        self._closures = {s: c for s, c in self._closures.items() if s in signatures}
+
+    def __len__(self) -> int:
+        return len(self._closures)
+
+
+class _CachedClosure:
+    """Member keys of a cached closure plus the packages already resolved from it"""
+
+    __slots__ = ("keys", "resolved")
+
+    def __init__(self, keys: Tuple[str, ...]) -> None:
+        self.keys = keys
+        self.resolved: Dict[str, Dependency] = dict()
+
+
+class DependencyGraph:
+    """All packages of a graph json-tree, with transitive closures resolved on demand
+
+    Closures are only computed for the keys that are asked for and whatever
+    they reach. Every strongly connected component is condensed and closed
+    once, in reverse topological order, and cached for later lookups.
+    """
+
+    def __init__(
+        self,
+        nodes: List[Dependency],
+        edges: List[List[int]],
+        backend: str = "auto",
+        closure_cache: Optional[ClosureCache] = None,
+    ) -> None:
+        self.nodes = nodes
+        self.edges = edges
+        self.positions = {node.key: i for i, node in enumerate(nodes)}
+        self.backend = create_closure_backend(backend, len(nodes))
+        self.closure_cache = closure_cache
+        self.cycles: List[List[str]] = []
+
+        self._closures: List[Any] = [None] * len(nodes)
+        self._signatures: List[Optional[str]] = [None] * len(nodes)
+        self._cached: List[Optional[_CachedClosure]] = [None] * len(nodes)
+        self._depths = [0] * len(nodes)
+        self._in_cycle = [False] * len(nodes)
+        self._resolved: Dict[int, Dependency] = dict()
+        self._index = [-1] * len(nodes)
+        self._lowlink = [0] * len(nodes)
+        self._on_stack = [False] * len(nodes)
+        self._stack: List[int] = []
+        self._counter = 0
+
+    @classmethod
+    def from_json(
+        cls, json_string: str, backend: str = "auto", closure_cache: Optional[ClosureCache] = None
+    ) -> "DependencyGraph":
+        return cls(*_index_packages(json.loads(json_string)), backend=backend, closure_cache=closure_cache)
+
+    @classmethod
+    def from_path(
+        cls, pipfile_graph: Path, backend: str = "auto", closure_cache: Optional[ClosureCache] = None
+    ) -> "DependencyGraph":
+        return cls(*_index_packages(iter_graph_packages(pipfile_graph)), backend=backend, closure_cache=closure_cache)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.positions
+
+    @property
+    def resolved_count(self) -> int:
+        """Number of packages whose closure has been computed so far"""
+        return sum(1 for closure in self._closures if closure is not None)
+
+    def signatures(self) -> FrozenSet[str]:
+        """Signatures of every closure resolved so far, only kept when the graph has a ClosureCache"""
+        return frozenset(s for s in self._signatures if s is not None)
+
+    def resolve(self, key: str) -> Dependency:
+        """The package behind key with its flattened transitive dependencies
+
+        The transitive dependencies are the graph's own nodes, shared between
+        every closure they're part of rather than copied into each of them.
+        """
+        i = self.positions[key]
+        if i not in self._resolved:
+            if self._closures[i] is None:
+                self._condense(i)
+            cached = self._cached[i]
+            if cached is None:
+                self._resolved[i] = self._materialize(i)
+            else:
+                if key not in cached.resolved:
+                    cached.resolved[key] = self._materialize(i)
+                self._resolved[i] = cached.resolved[key]
+
+        return self._resolved[i]
+
+    def closure_size(self, key: str) -> int:
+        """Number of packages key pulls in, not counting itself"""
+        i = self.positions[key]
+        if self._closures[i] is None:
+            self._condense(i)
+
+        closure = self._closures[i]
+        count = len(closure.keys) if isinstance(closure, _CachedClosure) else self.backend.count(closure)
+        return count - self._in_cycle[i]
+
+    def depth(self, key: str) -> int:
+        """Longest chain of requirements below key, where a cycle counts as one package"""
+        i = self.positions[key]
+        if self._closures[i] is None:
+            self._condense(i)
+
+        return self._depths[i]
+
+    def _closure(self, i: int) -> Any:
+        """The closure of a closed node, turning one taken from the ClosureCache into this graph's backend"""
+        closure = self._closures[i]
+        if isinstance(closure, _CachedClosure):
+            closure = self._closures[i] = self.backend.combine(map(self.positions.__getitem__, closure.keys), ())
+
+        return closure
+
+    def _materialize(self, i: int) -> Dependency:
+        node = self.nodes[i]
+        if isinstance(self._closures[i], _CachedClosure):
+            members: Iterable[int] = map(self.positions.__getitem__, self._closures[i].keys)
+        else:
+            members = self.backend.members(self._closures[i])
+        return Dependency(
+            node.key,
+            node.package_name,
+            node.installed_version,
+            dependencies=tuple(self.nodes[j] for j in members if j != i),
+        )
+
+    def dependencies(self, limit_to: Optional[Iterable[str]] = None) -> Iterator[Dependency]:
+        """Resolved packages in key order, only the ones in limit_to unless it is None or empty
+
+        An empty limit_to resolves every package, the same as create_build_file
+        treats it, so a Pipfile without packages still pins the whole graph.
+        """
+        limit = set() if limit_to is None else set(limit_to)
+        if limit:
+            keys: Iterable[str] = sorted(key for key in limit if key in self.positions)
+        else:
+            keys = (node.key for node in self.nodes)
+
+        for key in keys:
+            yield self.resolve(key)
+
+    def _condense(self, root: int) -> None:
+        """Tarjan's algorithm from root with an explicit stack instead of recursion
+
+        A component is emitted only after every component reachable from it,
+        so its closure can be assembled from already finished closures. Every
+        member of a cycle shares the same closure.
+        """
+        index, lowlink, on_stack, stack = self._index, self._lowlink, self._on_stack, self._stack
+
+        def visit(node: int) -> Iterator[int]:
+            index[node] = lowlink[node] = self._counter
+            self._counter += 1
+            stack.append(node)
+            on_stack[node] = True
+            return iter(self.edges[node])
+
+        work = [(root, visit(root))]
+        while work:
+            node, successors = work[-1]
+            for edge in successors:
+                if index[edge] == -1:
+                    work.append((edge, visit(edge)))
+                    break
+                if on_stack[edge]:
+                    lowlink[node] = min(lowlink[node], index[edge])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] != index[node]:
+                    continue
+
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                self._close(component)
+
+    def _close(self, component: List[int]) -> None:
+        members = set(component)
+        direct = []
+        cyclic = len(component) > 1 or component[0] in self.edges[component[0]]
+        if cyclic:
+            cycle = sorted(self.nodes[i].key for i in component)
+            _logger().warning("Dependency cycle between %s", ", ".join(cycle))
+            self.cycles.append(cycle)
+            direct.extend(component)
+
+        direct.extend(edge for i in component for edge in self.edges[i] if edge not in members)
+        successors = set(direct) - members
+        signature = cached = None
+        if self.closure_cache is not None:
+            signature = self._signature(component, successors)
+            cached = self.closure_cache.get(signature)
+        if cached is not None:
+            closure: Any = cached
+        else:
+            closure = self.backend.combine(direct, (self._closure(edge) for edge in successors))
+            if signature is not None:
+                keys = tuple(self.nodes[j].key for j in self.backend.members(closure))
+                cached = self.closure_cache.put(signature, keys)
+        depth = 1 + max(self._depths[edge] for edge in successors) if successors else 0
+        for i in component:
+            self._closures[i] = closure
+            self._signatures[i] = signature
+            self._cached[i] = cached
+            self._depths[i] = depth
+            self._in_cycle[i] = cyclic
+
+    def _signature(self, component: List[int], successors: Iterable[int]) -> str:
+        """Hash of the packages in component and the signatures of everything they depend on"""
+        import hashlib
+
+        h = hashlib.sha1()
+        for node in sorted((self.nodes[i] for i in component), key=lambda n: n.key):
+            h.update(f"{node.key}\0{node.package_name}\0{node.installed_version}\n".encode())
+        for signature in sorted(set(self._signatures[i] for i in successors)):
+            h.update(signature.encode())
+
+        return h.hexdigest()
+
+
+class ReverseIndex:
+    """Answers which direct dependencies pull in a package, and through which packages
+
+    For every direct dependency the index keeps the parent of each package it
+    reaches on a shortest path from it, so a path is read back one parent at
+    a time instead of searching the graph. It can be saved as JSON and loaded
+    again without reading the graph at all.
+    """
+
+    version = 1
+
+    def __init__(self, parents: Dict[str, Dict[str, str]], required_by: Dict[str, List[str]], source: str = "") -> None:
+        self.parents = parents
+        self.required_by = required_by
+        self.source = source
+        self._pulled_in_by: Dict[str, List[str]] = dict()
+        for root in sorted(parents):
+            for key in parents[root]:
+                self._pulled_in_by.setdefault(key, []).append(root)
+
+    @classmethod
+    def from_graph(cls, graph: DependencyGraph, roots: Iterable[str], source: str = "") -> "ReverseIndex":
+        required_by: Dict[str, List[str]] = {node.key: [] for node in graph.nodes}
+        for i, edges in enumerate(graph.edges):
+            for edge in edges:
+                required_by[graph.nodes[edge].key].append(graph.nodes[i].key)
+
+        parents = dict()
+        for root in sorted(set(key for key in roots if key in graph)):
+            start = graph.positions[root]
+            parent = {start: start}
+            queue = [start]
+            for i in queue:
+                for edge in graph.edges[i]:
+                    if edge not in parent:
+                        parent[edge] = i
+                        queue.append(edge)
+            parents[root] = {graph.nodes[i].key: graph.nodes[p].key for i, p in parent.items()}
+
+        return cls(parents, {key: sorted(set(keys)) for key, keys in required_by.items()}, source)
+
+    @classmethod
+    def load(cls, path: Path, source: str) -> Optional["ReverseIndex"]:
+        """The index saved at path, None if it's missing, unreadable or built from other files"""
+        try:
+            saved = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get("version") != cls.version or saved.get("source") != source:
+            return None
+
+        return cls(saved["parents"], saved["required_by"], source)
+
+    def save(self, path: Path) -> None:
+        index = dict(version=self.version, source=self.source, parents=self.parents, required_by=self.required_by)
+        write_if_changed(path, [json.dumps(index, sort_keys=True)])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.required_by
+
+    def pulled_in_by(self, key: str) -> List[str]:
+        """Direct dependencies that have key in their closure, key itself included when it's direct"""
+        return self._pulled_in_by.get(key, [])
+
+    def path(self, root: str, key: str) -> List[str]:
+        """A shortest chain of requirements from the direct dependency root to key"""
+        parents = self.parents[root]
+        path = [key]
+        while path[-1] != root:
+            path.append(parents[path[-1]])
+
+        return path[::-1]
+
+    def shortest_path(self, key: str) -> Optional[List[str]]:
+        return min((self.path(root, key) for root in self.pulled_in_by(key)), key=len, default=None)
+
+
+def index_source(pipfile: Path, pipfile_graph: Path) -> str:
+    """Identifies the inputs a ReverseIndex was built from"""
+    return f"{_file_digest(pipfile)}:{_file_digest(pipfile_graph)}"
+
+
+def why(key: str, index: ReverseIndex) -> str:
+    """Human readable answer to why key ends up in BUILD"""
+    key = key.lower()
+    if key not in index:
+        return f"{key} is not in the graph"
+
+    lines = [f"{key} is required by {', '.join(index.required_by[key]) or 'nothing'}"]
+    lines.extend(f"pulled in by {root}: {' -> '.join(index.path(root, key))}" for root in index.pulled_in_by(key))
+    if len(lines) == 1:
+        lines.append("no direct dependency pulls it in")
+
+    return "\n".join(lines)
+
+
+class GraphDiff:
+    __slots__ = ("added", "removed", "changed", "targets")
+
+    def __init__(
+        self,
+        added: List[Dependency],
+        removed: List[Dependency],
+        changed: List[Tuple[Dependency, Dependency]],
+        targets: List[str],
+    ) -> None:
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.targets = targets
+
+    def __str__(self) -> str:
+        lines = [f"added {d.key} {d.installed_version}" for d in self.added]
+        lines.extend(f"removed {d.key} {d.installed_version}" for d in self.removed)
+        lines.extend(f"changed {a.key} {a.installed_version} -> {b.installed_version}" for a, b in self.changed)
+        lines.extend(f"closure changed {key}" for key in self.targets)
+        return "\n".join(lines)
+
+
+def diff_graphs(old: DependencyGraph, new: DependencyGraph, direct_dependencies: Iterable[str]) -> GraphDiff:
+    """Packages that differ between two graphs and the direct dependencies whose pins change because of them
+
+    Only direct dependencies that reach a package that was added, removed,
+    changed version or changed its requirements are resolved, in both graphs,
+    to confirm their pins really differ.
+    """
+    old_keys, new_keys = old.positions, new.positions
+    added = [new.nodes[i] for key, i in new_keys.items() if key not in old_keys]
+    removed = [old.nodes[i] for key, i in old_keys.items() if key not in new_keys]
+    changed = [
+        (old.nodes[i], new.nodes[new_keys[key]])
+        for key, i in old_keys.items()
+        if key in new_keys and old.nodes[i] != new.nodes[new_keys[key]]
+    ]
+    rewired = [
+        key
+        for key, i in old_keys.items()
+        if key in new_keys
+        and set(old.nodes[edge].key for edge in old.edges[i])
+        != set(new.nodes[edge].key for edge in new.edges[new_keys[key]])
+    ]
+
+    touched = set(d.key for d in added + removed) | set(o.key for o, _ in changed) | set(rewired)
+    candidates = _reaching(old, touched) | _reaching(new, touched)
+    targets = [key for key in sorted(set(direct_dependencies) & candidates) if _pins(old, key) != _pins(new, key)]
+    return GraphDiff(added, removed, changed, targets)
+
+
+def _reaching(graph: DependencyGraph, keys: Iterable[str]) -> FrozenSet[str]:
+    """Every key of graph from which one of keys can be reached, keys included"""
+    required_by: List[List[int]] = [[] for _ in graph.nodes]
+    for i, edges in enumerate(graph.edges):
+        for edge in edges:
+            required_by[edge].append(i)
+
+    seen = set(graph.positions[key] for key in keys if key in graph)
+    queue = list(seen)
+    for i in queue:
+        for parent in required_by[i]:
+            if parent not in seen:
+                seen.add(parent)
+                queue.append(parent)
+
+    return frozenset(graph.nodes[i].key for i in seen)
+
+
+def _pins(graph: DependencyGraph, key: str) -> FrozenSet[Tuple[str, str]]:
+    if key not in graph:
+        return frozenset()
+
+    return frozenset((d.package_name, d.installed_version) for d in graph.resolve(key))
+
+
+def analyze_graph(graph: DependencyGraph, direct_dependencies: Iterable[str], top: int = 10) -> Dict[str, Any]:
+    """Size and shape of the graph and of what every direct dependency pins
+
+    Closure sizes and depths come from the condensed graph, where each
+    strongly connected component is closed once. targets is how many direct
+    dependencies pin a package, itself included.
+    """
+    fan_in = [0] * len(graph)
+    for edges in graph.edges:
+        for edge in set(edges):
+            fan_in[edge] += 1
+
+    targets = [0] * len(graph)
+    direct = sorted(set(key for key in direct_dependencies if key in graph))
+    for key in direct:
+        for d in graph.resolve(key):
+            targets[graph.positions[d.key]] += 1
+
+    packages = dict()
+    histogram: Dict[int, int] = dict()
+    for i, node in enumerate(graph.nodes):
+        size = graph.closure_size(node.key)
+        packages[node.key] = dict(
+            fan_in=fan_in[i],
+            fan_out=len(set(graph.edges[i])),
+            closure_size=size,
+            depth=graph.depth(node.key),
+            targets=targets[i],
+        )
+        histogram[size.bit_length()] = histogram.get(size.bit_length(), 0) + 1
+
+    def ranked(metric: str, keys: Iterable[str]) -> List[Dict[str, Any]]:
+        ranking = sorted((k for k in keys if packages[k][metric]), key=lambda k: (-packages[k][metric], k))
+        return [dict(package=k, **{metric: packages[k][metric]}) for k in ranking[:top]]
+
+    return dict(
+        summary=dict(
+            nodes=len(graph),
+            edges=sum(fan_in),
+            cycles=len(graph.cycles),
+            direct_dependencies=len(direct),
+            max_depth=max((p["depth"] for p in packages.values()), default=0),
+        ),
+        closure_size_histogram={_histogram_bucket(b): histogram[b] for b in sorted(histogram)},
+        heaviest_targets=ranked("closure_size", direct),
+        most_pinned=ranked("targets", packages),
+        most_required=ranked("fan_in", packages),
+        packages=packages,
+    )
+
+
+def _histogram_bucket(bits: int) -> str:
+    low, high = (1 << bits) >> 1, (1 << bits) - 1
+    return str(high) if low >= high else f"{low}-{high}"
+
+
+def format_analytics(report: Dict[str, Any]) -> str:
+    """The analyze_graph report as tables, without the per-package metrics"""
+    lines = [f"{name:<24}{value:>12}" for name, value in report["summary"].items()]
+    lines.extend(["", f"{'closure size':<24}{'packages':>12}"])
+    lines.extend(f"{bucket:<24}{count:>12}" for bucket, count in report["closure_size_histogram"].items())
+    rankings = [("heaviest_targets", "closure_size"), ("most_pinned", "targets"), ("most_required", "fan_in")]
+    for title, metric in rankings:
+        lines.extend(["", f"{title.replace('_', ' '):<48}{metric:>12}"])
+        lines.extend(f"{r['package']:<48}{r[metric]:>12}" for r in report[title])
+
+    return "\n".join(lines)
 
 
 def _instantiate_and_flatten_dependencies(deps: List[Dict[str, Any]]) -> Iterable[Dependency]:
@@ -99,69 +1040,933 @@ def _instantiate_and_flatten_dependencies(deps: List[Dict[str, Any]]) -> Iterabl
             yield from _instantiate_and_flatten_dependencies(d["dependencies"])
 
 
+PIPFILE_SECTIONS = ("dev-packages", "packages")
+_TABLE = re.compile(r"""^\[\s*([A-Za-z0-9_-]+|"[^"\\]*"|'[^']*')\s*\]\s*(?:#.*)?$""")
+_KEY_VALUE = re.compile(r"""^([A-Za-z0-9_-]+|"[^"\\]*"|'[^']*')\s*=\s*(.*)$""")
+
+
 def read_direct_dependencies(pipfile_string: str) -> List[str]:
-    config = toml.loads(pipfile_string)
-    dependencies = []
-    for section in ("dev-packages", "packages"):
-        dependencies.extend(map(lambda s: s.lower(), config.get(section, {}).keys()))
+    dependencies = _read_package_names(pipfile_string)
+    if dependencies is None:
+        config = _load_toml(pipfile_string)
+        dependencies = [name for section in PIPFILE_SECTIONS for name in config.get(section, {}).keys()]
+
+    return list(sorted(set(map(lambda s: s.lower(), dependencies))))
+
+
+def _read_package_names(pipfile_string: str) -> Optional[List[str]]:
+    """Keys of the package tables without parsing the rest of the Pipfile
+
+    Only understands the line-per-key layout pipenv writes. Returns None on
+    anything else (multi-line strings or arrays, dotted keys, sub-tables)
+    so the caller can hand the file to a real TOML parser instead.
+    """
+    names = []
+    section = None
+    for line in pipfile_string.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if '"""' in line or "'''" in line:
+            return None
+        if line.startswith("[["):
+            section = None
+            continue
+
+        match = (_TABLE if line.startswith("[") else _KEY_VALUE).match(line)
+        if match is None:
+            return None
+        if line.startswith("["):
+            section = _unquote(match.group(1))
+            continue
+
+        value = match.group(2)
+        if value.count("[") != value.count("]") or value.count("{") != value.count("}"):
+            return None
+        if section in PIPFILE_SECTIONS:
+            names.append(_unquote(match.group(1)))
+
+    return names
+
+
+def _unquote(key: str) -> str:
+    return key[1:-1] if key[:1] in "\"'" else key
+
+
+def _load_toml(toml_string: str) -> Dict[str, Any]:
+    try:
+        import tomllib
+    except ImportError:
+        import toml
+
+        return toml.loads(toml_string)
+
+    return tomllib.loads(toml_string)
 
-    return list(sorted(set(dependencies)))
+
+LOCK_SECTIONS = ("default", "develop")
+
+
+def read_lock_pins(lock_string: str) -> Dict[str, str]:
+    """Exact versions from a Pipfile.lock keyed by canonical name
+
+    Entries without a version, like VCS or path requirements, are left out.
+    """
+    lock = json.loads(lock_string)
+    pins = dict()
+    for section in LOCK_SECTIONS:
+        for name, entry in lock.get(section, {}).items():
+            if "version" in entry:
+                pins[_canonical_name(name)] = entry["version"].lstrip("=")
+
+    return pins
+
+
+def join_lock_pins(nodes: List[Dependency], pins: Dict[str, str]) -> List[Dependency]:
+    """Nodes with the versions of the lock, logging every package the graph and the lock disagree on
+
+    A single pass over the nodes with one dict lookup each. Packages missing
+    from the lock keep the version of the graph.
+    """
+    joined = []
+    unmatched = dict(pins)
+    for node in nodes:
+        version = unmatched.pop(_canonical_name(node.key), None)
+        if version is None:
+            _logger().warning("%s %s is in the graph but not in the lock", node.key, node.installed_version)
+            joined.append(node)
+        elif version != node.installed_version:
+            _logger().warning("%s is %s in the graph but %s in the lock", node.key, node.installed_version, version)
+            joined.append(Dependency(node.key, node.package_name, sys.intern(version)))
+        else:
+            joined.append(node)
+
+    for name, version in sorted(unmatched.items()):
+        _logger().warning("%s %s is in the lock but not in the graph", name, version)
+
+    return joined
 
 
 def create_build_file(
-    all_dependencies: Iterable[Dependency], limit_to: Optional[Iterable[str]] = None
+    all_dependencies: Iterable[Dependency],
+    limit_to: Optional[Iterable[str]] = None,
+    target_format: str = "v1",
 ) -> str:
+    """One python_requirement_library per direct dependency with every transitive pin inlined"""
+    return "\n".join(iter_targets(all_dependencies, limit_to, target_format))
+
+
+def iter_targets(
+    all_dependencies: Iterable[Dependency],
+    limit_to: Optional[Iterable[str]] = None,
+    target_format: str = "v1",
+) -> Iterator[str]:
+    """The targets of create_build_file one at a time"""
     if limit_to is None:
         limit_to = set()
 
-    build = []
+    renderer = TARGET_FORMATS[target_format]
     for dependency in all_dependencies:
         if limit_to and dependency.key not in limit_to:
             continue
 
-        build.append(
-            textwrap.dedent(
-                """
-                python_requirement_library(
-                    name="{package_name}",
-                    requirements=[
-                        {dependencies}
-                    ],
-                )
-                """.format(
-                    package_name=dependency.package_name,
-                    version=dependency.installed_version,
-                    dependencies=_build_requirements_string(dependency, indent_level=6),
-                )
+        yield renderer.library(dependency)
+
+
+def create_shared_build_file(
+    all_dependencies: Iterable[Dependency], limit_to: Optional[Iterable[str]] = None, target_format: str = "v1"
+) -> str:
+    """One pinned target per package, which the direct dependencies point at
+
+    Every pin is written exactly once no matter how many direct dependencies
+    pull it in, instead of being copied into each of them. A direct
+    dependency depends on the pinned targets of itself and its whole
+    closure, so it resolves to exactly the same pins as the inlined format.
+    """
+    return "\n".join(iter_shared_targets(all_dependencies, limit_to, target_format))
+
+
+def iter_shared_targets(
+    all_dependencies: Iterable[Dependency], limit_to: Optional[Iterable[str]] = None, target_format: str = "v1"
+) -> Iterator[str]:
+    """The targets of create_shared_build_file one at a time"""
+    if limit_to is None:
+        limit_to = set()
+
+    renderer = TARGET_FORMATS[target_format]
+    pinned: Dict[str, Dependency] = dict()
+    for dependency in all_dependencies:
+        if limit_to and dependency.key not in limit_to:
+            continue
+
+        yield renderer.alias(dependency)
+        for d in dependency:
+            pinned.setdefault(d.key, d)
+
+    for key in sorted(pinned):
+        yield renderer.pinned(pinned[key])
+
+
+class TargetRenderer:
+    """Renders targets from a template that is split into its fixed pieces once
+
+    Rendering a target is then a single join of those pieces with the names
+    and pins of a dependency, instead of dedenting and formatting the whole
+    template every time. requirement is how one pin is written, with {} where
+    the pin goes.
+    """
+
+    def __init__(self, name: str, library: str, requirement: str) -> None:
+        self.name = name
+        prefix, suffix = requirement.split("{}")
+        self._requirement_prefix = " " * 8 + prefix
+        self._requirement_suffix = suffix + ",\n"
+        self._library_head = f'\n{library}(\n    name="'
+        self._alias_head = '\ntarget(\n    name="'
+        self._requirements_head = '",\n    requirements=[\n'
+        self._dependencies_head = '",\n    dependencies=[\n'
+        self._tail = "    ],\n)\n"
+
+    def library(self, dependency: Dependency) -> str:
+        """A library pinning the dependency itself and everything it pulls in"""
+        return self._library(dependency.package_name, dependency)
+
+    def pinned(self, dependency: Dependency) -> str:
+        """A library pinning only the dependency itself"""
+        return self._library(_pinned_target_name(dependency), (dependency,))
+
+    def alias(self, dependency: Dependency) -> str:
+        """A target depending on the pinned targets of the dependency and everything it pulls in"""
+        lines = "".join(f'        ":{_pinned_target_name(d)}",\n' for d in dependency)
+        return f"{self._alias_head}{dependency.package_name}{self._dependencies_head}{lines}{self._tail}"
+
+    def _library(self, name: str, pins: Iterable[Dependency]) -> str:
+        prefix, suffix = self._requirement_prefix, self._requirement_suffix
+        lines = "".join(f"{prefix}{d.package_name}=={d.installed_version}{suffix}" for d in pins)
+        return f"{self._library_head}{name}{self._requirements_head}{lines}{self._tail}"
+
+
+def _pinned_target_name(dependency: Dependency) -> str:
+    return f"pinned-{dependency.package_name}"
+
+
+TARGET_FORMATS = {
+    r.name: r
+    for r in (
+        TargetRenderer("v1", "python_requirement_library", 'python_requirement("{}")'),
+        TargetRenderer("v2", "python_requirement_library", '"{}"'),
+    )
+}
+
+
+OUTPUT_MODES = dict(inline=iter_targets, shared=iter_shared_targets)
+HEADER = "# Generated by tools/pipenv_graph_to_build.py. See README for how to regenerate.\n"
+SHARDS_MANIFEST = ".BUILD.shards"
+
+
+def iter_build_file(targets: Iterable[str]) -> Iterator[str]:
+    """The header and the targets, separated and stripped the same way as the joined create_build_file"""
+    yield HEADER
+    for i, target in enumerate(targets):
+        if i == 0:
+            yield target.lstrip()
+        else:
+            yield "\n"
+            yield target
+
+
+class BuildEmitter:
+    """BUILD in the requested output mode and target format"""
+
+    name = "build"
+
+    def __init__(self, output_mode: str = "inline", target_format: str = "v1") -> None:
+        self.output_mode = output_mode
+        self.target_format = target_format
+
+    def chunks(self, resolved: List[Dependency]) -> Iterator[str]:
+        return iter_build_file(OUTPUT_MODES[self.output_mode](resolved, target_format=self.target_format))
+
+
+class ConstraintsEmitter:
+    """A pip constraints file pinning every package any direct dependency pulls in"""
+
+    name = "constraints"
+
+    def chunks(self, resolved: List[Dependency]) -> Iterator[str]:
+        pins: Dict[str, str] = dict()
+        for dependency in resolved:
+            for d in dependency:
+                pins.setdefault(d.package_name, d.installed_version)
+
+        yield HEADER
+        for package_name in sorted(pins):
+            yield f"{package_name}=={pins[package_name]}\n"
+
+
+class ManifestEmitter:
+    """JSON with the pin and the pinned closure of every direct dependency, keyed by target name"""
+
+    name = "manifest"
+    version = 1
+
+    def chunks(self, resolved: List[Dependency]) -> Iterator[str]:
+        targets = {
+            dependency.package_name: dict(
+                requirement=f"{dependency.package_name}=={dependency.installed_version}",
+                closure=sorted(f"{d.package_name}=={d.installed_version}" for d in dependency.dependencies),
             )
+            for dependency in resolved
+        }
+        yield json.dumps(dict(version=self.version, targets=targets), indent=4, sort_keys=True)
+        yield "\n"
+
+
+EMITTERS = {e.name: e for e in (BuildEmitter, ConstraintsEmitter, ManifestEmitter)}
+
+
+def create_emitter(name: str, output_mode: str = "inline", target_format: str = "v1") -> Any:
+    """The emitter behind --emit name, where build follows the output mode and target format of the run"""
+    if name == BuildEmitter.name:
+        # A sharded run emits the single BUILD the shards were split from
+        return BuildEmitter("inline" if output_mode == "sharded" else output_mode, target_format)
+
+    return EMITTERS[name]()
+
+
+def write_build(
+    resolved: List[Dependency],
+    build_file: Path,
+    output_mode: str = "inline",
+    target_format: str = "v1",
+) -> Tuple[List[Path], bool, int, int]:
+    """Writes build_file, or the shards next to it replacing a generated build_file when output_mode is sharded
+
+    Returns the files making up the BUILD, whether any of them changed and
+    how many shards were written and removed.
+    """
+    if output_mode != "sharded":
+        written = write_if_changed(build_file, BuildEmitter(output_mode, target_format).chunks(resolved))
+        return [build_file], written, 0, 0
+
+    shards, shards_written, shards_removed = write_shards(resolved, build_file.parent, target_format)
+    written = remove_generated(build_file) or shards_written + shards_removed > 0
+    return shards, written, shards_written, shards_removed
+
+
+def write_shards(
+    resolved: List[Dependency],
+    root: Path,
+    target_format: str = "v1",
+) -> Tuple[List[Path], int, int]:
+    """Writes every direct dependency's target to root/<package>/BUILD and removes shards of dropped ones
+
+    The shards and a hash of their content are listed in root/.BUILD.shards.
+    A shard whose rendered content hashes the same as listed there, and
+    whose file still has that size, isn't touched at all, so a version bump
+    only costs I/O for the shards that pin it. Only shards listed by the
+    previous run that still start with HEADER are ever removed, so generated
+    BUILD files of other projects below root are left alone. Returns the
+    shards, how many were written and how many were removed.
+    """
+    import hashlib
+
+    manifest = root / SHARDS_MANIFEST
+    try:
+        manifest_text = manifest.read_text()
+        previous = json.loads(manifest_text)
+    except (OSError, ValueError):
+        manifest_text, previous = "", dict()
+    if not isinstance(previous, dict):
+        previous = dict()
+
+    renderer = TARGET_FORMATS[target_format]
+    shards = []
+    digests: Dict[str, str] = dict()
+    written = 0
+    for dependency in resolved:
+        content = "".join(iter_build_file([renderer.library(dependency)])).encode("utf-8")
+        digest = digests[dependency.package_name] = hashlib.sha256(content).hexdigest()
+        shard = root / dependency.package_name / "BUILD"
+        stamp = _stamp(shard)
+        if previous.get(dependency.package_name) != digest or stamp is None or stamp[0] != len(content):
+            shard.parent.mkdir(exist_ok=True)
+            written += write_if_changed(shard, [content])
+        shards.append(shard)
+
+    removed = 0
+    for name in sorted(set(previous) - set(digests)):
+        directory = root / name
+        if remove_generated(directory / "BUILD"):
+            removed += 1
+            if not any(directory.iterdir()):
+                directory.rmdir()
+    text = json.dumps(digests, indent=4, sort_keys=True) + "\n"
+    if text != manifest_text:
+        write_if_changed(manifest, [text])
+
+    return shards, written, removed
+
+
+def remove_generated(path: Path) -> bool:
+    """Deletes path if this script wrote it, returns whether it did"""
+    try:
+        with path.open(encoding="utf-8") as f:
+            generated = f.read(len(HEADER)) == HEADER
+    except (OSError, UnicodeDecodeError):
+        return False
+
+    if generated:
+        path.unlink()
+
+    return generated
+
+
+def write_if_changed(path: Path, chunks: Iterable[Union[str, bytes]]) -> bool:
+    """Streams chunks into a temporary file next to path and renames it into place
+
+    The rename is atomic so a crash never leaves a truncated file behind. When
+    the content hashes the same as what's already there the temporary file is
+    dropped instead, so path isn't touched at all. Returns whether it was
+    written. Text chunks are written as UTF-8.
+    """
+    import hashlib
+    import tempfile
+
+    digest = hashlib.sha256()
+    fd, temporary = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                f.write(data)
+                digest.update(data)
+
+        if path.exists() and _file_digest(path) == digest.hexdigest():
+            os.unlink(temporary)
+            return False
+
+        os.chmod(temporary, stat.S_IMODE(path.stat().st_mode) if path.exists() else 0o666 & ~_umask())
+        os.replace(temporary, str(path))
+        return True
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+def _file_digest(path: Path) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class Instrumentation:
+    """Wall and CPU time per stage of main plus counters describing the work done"""
+
+    enabled = True
+
+    def __init__(self, cprofile: Optional[Path] = None) -> None:
+        self.cprofile = cprofile
+        self.stages: Dict[str, Dict[str, float]] = dict()
+        self.counters: Dict[str, Any] = dict()
+
+    @contextmanager
+    def stage(self, name: str, profile: bool = False) -> Iterator[None]:
+        profiler = None
+        if profile and self.cprofile is not None:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = dict(wall=time.perf_counter() - wall, cpu=time.process_time() - cpu)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(str(self.cprofile))
+
+    def count(self, **counters: Any) -> None:
+        self.counters.update(counters)
+
+    def report(self, report_format: str = "table") -> str:
+        if report_format == "json":
+            return json.dumps(dict(stages=self.stages, counters=self.counters), indent=4)
+
+        lines = [f"{'stage':<24}{'wall s':>12}{'cpu s':>12}"]
+        lines.extend(f"{name:<24}{t['wall']:>12.4f}{t['cpu']:>12.4f}" for name, t in self.stages.items())
+        lines.append("")
+        lines.extend(f"{name:<24}{value:>24}" for name, value in self.counters.items())
+        return "\n".join(lines)
+
+
+class _DisabledInstrumentation:
+    """Stands in for Instrumentation when --profile isn't given so main pays nothing for it"""
+
+    enabled = False
+
+    def stage(self, name: str, profile: bool = False) -> "_DisabledInstrumentation":
+        return self
+
+    def count(self, **counters: Any) -> None:
+        pass
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+
+def main(
+    pipfile: Path,
+    pipfile_graph: Path,
+    build_file: Path,
+    closure_backend: str = "auto",
+    sort_graph: bool = False,
+    site_packages: Optional[Path] = None,
+    instrumentation: Optional[Instrumentation] = None,
+    output_mode: str = "inline",
+    target_format: str = "v1",
+    closure_cache: Optional[ClosureCache] = None,
+    reverse_index: Optional[Path] = None,
+    snapshot: bool = False,
+    outputs: Iterable[Tuple[str, Path]] = (),
+    pipfile_lock: Optional[Path] = None,
+) -> None:
+    stats = instrumentation or _DisabledInstrumentation()
+
+    with stats.stage("read_graph"):
+        graph_snapshot = GraphSnapshot.next_to(pipfile_graph) if snapshot else None
+        if site_packages is not None:
+            indexed = _index_packages(write_graph_file(pipfile_graph, collect_graph(site_packages)))
+        elif sort_graph:
+            indexed = _index_packages(sort_graph_file(pipfile_graph))
+        elif graph_snapshot is not None:
+            indexed = graph_snapshot.index()
+        else:
+            indexed = _index_packages(iter_graph_packages(pipfile_graph))
+        nodes, edges = indexed
+        if pipfile_lock is not None:
+            nodes = join_lock_pins(nodes, read_lock_pins(pipfile_lock.read_text()))
+        graph = DependencyGraph(nodes, edges, backend=closure_backend, closure_cache=closure_cache)
+    with stats.stage("read_pipfile"):
+        direct_dependencies = read_direct_dependencies(pipfile.read_text())
+    with stats.stage("resolve", profile=True):
+        resolved = list(graph.dependencies(direct_dependencies))
+
+    with stats.stage("render_and_write"):
+        written_files, written, shards_written, shards_removed = write_build(
+            resolved, build_file, output_mode, target_format
+        )
+    for name, path in outputs:
+        with stats.stage(f"emit_{name}"):
+            write_if_changed(path, create_emitter(name, output_mode, target_format).chunks(resolved))
+    if reverse_index is not None:
+        with stats.stage("reverse_index"):
+            source = index_source(pipfile, pipfile_graph)
+            ReverseIndex.from_graph(graph, direct_dependencies, source).save(reverse_index)
+
+    if stats.enabled:
+        closure_sizes = [len(d.dependencies) for d in resolved]
+        stats.count(
+            backend=graph.backend.name,
+            nodes=len(graph),
+            edges=sum(map(len, graph.edges)),
+            cycles=len(graph.cycles),
+            direct_dependencies=len(direct_dependencies),
+            targets=len(resolved),
+            closures_resolved=graph.resolved_count,
+            closure_size_total=sum(closure_sizes),
+            closure_size_max=max(closure_sizes, default=0),
+            output_bytes=sum(f.stat().st_size for f in written_files),
+            build_file_written=written,
         )
+        if output_mode == "sharded":
+            stats.count(shards_written=shards_written, shards_removed=shards_removed)
+        if graph_snapshot is not None:
+            stats.count(snapshot_hit=graph_snapshot.hit)
 
-    return "\n".join(build)
 
+def run_batch(projects: List[Path], jobs: Optional[int] = None, **options: Any) -> List[Dict[str, Any]]:
+    """Runs main for every project directory holding a Pipfile and a Pipfile.lock.graph
 
-def _build_requirements_string(dependency: Dependency, indent_level=0) -> str:
-    indent = " " * (4 * indent_level)
-    return f"\n{indent}".join(
-        'python_requirement("{}=={}"),'.format(d.package_name, d.installed_version) for d in dependency
+    Projects are dealt round robin to jobs groups, and every group runs in
+    order in one worker process with a single ClosureCache. The cache is
+    per worker and not shared across the pool, so closures are only reused
+    between projects of the same group. A pipfile_lock option names the
+    lock inside every project. Returns timing and cache statistics per
+    project in the order they were given. A project that fails is reported
+    with its error instead of stopping the batch.
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(projects)) or 1
+    if jobs == 1:
+        return _run_projects(list(map(str, projects)), options)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    groups = [list(map(str, projects[i::jobs])) for i in range(jobs)]
+    with ProcessPoolExecutor(jobs) as executor:
+        results = {r["project"]: r for group in executor.map(_run_projects, groups, [options] * jobs) for r in group}
+
+    return [results[str(project)] for project in projects]
+
+
+def _run_projects(projects: List[str], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    cache = ClosureCache()
+    return [_run_project(project, cache, options) for project in projects]
+
+
+def _run_project(project: str, cache: ClosureCache, options: Dict[str, Any]) -> Dict[str, Any]:
+    directory = Path(project)
+    hits, misses = cache.hits, cache.misses
+    start = time.perf_counter()
+    options = dict(options)
+    pipfile_lock = options.pop("pipfile_lock", None)
+    error = None
+    try:
+        main(
+            directory / "Pipfile",
+            directory / "Pipfile.lock.graph",
+            directory / "BUILD",
+            closure_cache=cache,
+            pipfile_lock=directory / pipfile_lock if pipfile_lock else None,
+            **options,
+        )
+    except (OSError, ValueError, KeyError) as e:
+        error = f"{type(e).__name__}: {e}"
+    return dict(
+        project=project,
+        seconds=time.perf_counter() - start,
+        cache_hits=cache.hits - hits,
+        cache_misses=cache.misses - misses,
+        error=error,
     )
 
 
-def main(pipfile: Path, pipfile_graph: Path, build_file: Path) -> None:
-    all_dependencies = read_dependencies(pipfile_graph.read_text())
-    direct_dependencies = read_direct_dependencies(pipfile.read_text())
+def find_projects(patterns: Iterable[str], manifest: Optional[Path] = None) -> List[Path]:
+    """Directories holding a Pipfile and a Pipfile.lock.graph that match the glob patterns or a JSON manifest
+
+    Patterns in the manifest are relative to the manifest.
+    """
+    import glob
+
+    patterns = [(Path(), pattern) for pattern in patterns]
+    if manifest is not None:
+        patterns.extend((manifest.parent, pattern) for pattern in json.loads(manifest.read_text()))
+
+    projects: List[Path] = []
+    for base, pattern in patterns:
+        for match in sorted(glob.glob(str(base / pattern))):
+            project = Path(match)
+            complete = (project / "Pipfile").exists() and (project / "Pipfile.lock.graph").exists()
+            if complete and project not in projects:
+                projects.append(project)
+
+    return projects
+
 
-    build_file.write_text(
-        "# Generated by tools/pipenv_graph_to_build.py. See README for how to regenerate.\n"
-        + create_build_file(all_dependencies, direct_dependencies).lstrip()
+def batch_summary(results: List[Dict[str, Any]]) -> str:
+    lines = [f"{'project':<48}{'seconds':>10}{'hits':>8}{'misses':>8}"]
+    lines.extend(
+        f"{r['project']:<48}{r['seconds']:>10.3f}{r['cache_hits']:>8}{r['cache_misses']:>8}" for r in results
     )
+    lines.append(
+        f"{'total':<48}{sum(r['seconds'] for r in results):>10.3f}"
+        f"{sum(r['cache_hits'] for r in results):>8}{sum(r['cache_misses'] for r in results):>8}"
+    )
+    lines.extend(f"{r['project']} failed: {r['error']}" for r in results if r["error"] is not None)
+    return "\n".join(lines)
+
+
+class Watcher:
+    """Regenerates BUILD whenever Pipfile, the graph, the Pipfile.lock it pins or BUILD itself change on disk
+
+    The graph and its resolved closures stay in memory between changes, so
+    a changed Pipfile only resolves the direct dependencies that weren't
+    resolved before. A changed graph is parsed again in full, but only the
+    packages whose subgraph changed have their closures combined again, the
+    rest come from a ClosureCache. The cache only keeps the closures of the
+    current graph, so it doesn't grow over a long session. Every --emit
+    output and the reverse index are written along with BUILD. Changes are
+    found by polling size and modification time, which works on any
+    filesystem and in containers.
+    """
+
+    def __init__(
+        self,
+        pipfile: Path,
+        pipfile_graph: Path,
+        build_file: Path,
+        closure_backend: str = "auto",
+        output_mode: str = "inline",
+        target_format: str = "v1",
+        pipfile_lock: Optional[Path] = None,
+        outputs: Iterable[Tuple[str, Path]] = (),
+        reverse_index: Optional[Path] = None,
+    ) -> None:
+        self.pipfile = pipfile
+        self.pipfile_graph = pipfile_graph
+        self.build_file = build_file
+        self.closure_backend = closure_backend
+        self.output_mode = output_mode
+        self.target_format = target_format
+        self.pipfile_lock = pipfile_lock
+        self.outputs = list(outputs)
+        self.reverse_index = reverse_index
+        self.closure_cache = ClosureCache()
+        self.graph: Optional[DependencyGraph] = None
+        self.direct_dependencies: Optional[List[str]] = None
+        self._stamps: Dict[Path, Optional[Tuple[int, int]]] = dict()
+
+    def poll(self) -> bool:
+        """Regenerates BUILD if a watched file changed since the last poll, returns whether anything changed
+
+        A file that can't be read, like a graph that is only half written,
+        is logged and read again after its next change.
+        """
+        watched = [self.pipfile, self.pipfile_graph, self.build_file]
+        if self.pipfile_lock is not None:
+            watched.append(self.pipfile_lock)
+        stamps = {path: _stamp(path) for path in watched}
+        changed = set(path for path, stamp in stamps.items() if self._stamps.get(path, ()) != stamp)
+        if not changed:
+            return False
+
+        try:
+            if self.graph is None or self.pipfile_graph in changed or self.pipfile_lock in changed:
+                self.graph = None
+                nodes, edges = _index_packages(iter_graph_packages(self.pipfile_graph))
+                if self.pipfile_lock is not None:
+                    nodes = join_lock_pins(nodes, read_lock_pins(self.pipfile_lock.read_text()))
+                self.graph = DependencyGraph(nodes, edges, self.closure_backend, self.closure_cache)
+            if self.direct_dependencies is None or self.pipfile in changed:
+                self.direct_dependencies = None
+                self.direct_dependencies = read_direct_dependencies(self.pipfile.read_text())
+
+            resolved = list(self.graph.dependencies(self.direct_dependencies))
+            # closures of replaced graphs would otherwise pile up along with every package resolved from them
+            self.closure_cache.retain(self.graph.signatures())
+            write_build(resolved, self.build_file, self.output_mode, self.target_format)
+            for name, path in self.outputs:
+                write_if_changed(path, create_emitter(name, self.output_mode, self.target_format).chunks(resolved))
+            if self.reverse_index is not None:
+                source = index_source(self.pipfile, self.pipfile_graph)
+                ReverseIndex.from_graph(self.graph, self.direct_dependencies, source).save(self.reverse_index)
+        except (OSError, ValueError, KeyError) as e:
+            _logger().error("Could not regenerate %s: %s", self.build_file, e)
+
+        # BUILD is stamped after writing it so the write doesn't count as a change
+        self._stamps = {**stamps, self.build_file: _stamp(self.build_file)}
+        return True
+
+    def run(self, interval: float = 0.2) -> None:
+        while True:
+            start = time.perf_counter()
+            if self.poll():
+                milliseconds = (time.perf_counter() - start) * 1000
+                print(f"Regenerated {self.build_file} in {milliseconds:.1f} ms", file=sys.stderr)
+            time.sleep(interval)
+
+
+def _stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        s = path.stat()
+    except OSError:
+        return None
+
+    return s.st_size, s.st_mtime_ns
 
 
 if __name__ == "__main__":
+    from argparse import ArgumentParser
+
     parser = ArgumentParser()
     parser.add_argument("--pipfile", default="Pipfile")
     parser.add_argument("--pipfile-graph", default="Pipfile.lock.graph")
     parser.add_argument("--build-file", default="BUILD")
+    parser.add_argument(
+        "--closure-backend",
+        default="auto",
+        choices=["auto", *CLOSURE_BACKENDS],
+        help="How transitive closures are stored while resolving, auto picks by graph size",
+    )
+    parser.add_argument(
+        "--sort-graph",
+        action="store_true",
+        help="Also rewrite the graph file sorted by key, from the same parse that generates BUILD",
+    )
+    parser.add_argument(
+        "--output-mode",
+        default="inline",
+        choices=[*OUTPUT_MODES, "sharded"],
+        help="inline copies every transitive pin into each target, shared writes one pinned target per package"
+        " that the direct dependencies depend on, sharded writes the inline target of every direct dependency to"
+        " <package>/BUILD next to --build-file",
+    )
+    parser.add_argument(
+        "--target-format",
+        default="v1",
+        choices=list(TARGET_FORMATS),
+        help="v1 writes python_requirement() objects, v2 writes requirement strings as Pants 2 expects",
+    )
+    parser.add_argument(
+        "--site-packages",
+        help="Collect the graph from a site-packages directory or virtualenv instead of reading"
+        " --pipfile-graph, which is then written with the collected graph",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["table", "json"],
+        help="Print time spent per stage and counters describing the graph to stderr",
+    )
+    parser.add_argument("--cprofile", help="Dump cProfile stats of the resolve stage to this file, needs --profile")
+    parser.add_argument("--reverse-index", help="Also write the index the why command reads to this file")
+    parser.add_argument(
+        "--pipfile-lock",
+        help="Pin the exact versions of this Pipfile.lock instead of the graph's, warning about every difference."
+        " batch reads it relative to every project",
+    )
+    parser.add_argument(
+        "--emit",
+        action="append",
+        default=[],
+        metavar="FORMAT=PATH",
+        help=f"Also write the same pins in another format to PATH, any of {', '.join(EMITTERS)}. Can be repeated",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Keep a binary snapshot of the parsed graph next to --pipfile-graph and load it while the graph is"
+        " unchanged, ignored with --sort-graph and --site-packages",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser(
+        "batch",
+        help="Generate BUILD for many project directories, sharing resolved closures between them",
+    )
+    batch.add_argument("projects", nargs="*", help="Glob patterns of directories holding a Pipfile")
+    batch.add_argument("--manifest", help="JSON list of project directories or globs, relative to the manifest")
+    batch.add_argument("--jobs", type=int, help="Worker processes, defaults to the number of CPUs")
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Stay running and regenerate BUILD whenever Pipfile, the graph or BUILD change",
+    )
+    watch_parser.add_argument("--interval", type=float, default=0.2, help="Seconds between checks for changes")
+    analytics_parser = subparsers.add_parser(
+        "analytics",
+        help="Report fan-in, fan-out, closure sizes and depth of every package and the heaviest direct dependencies",
+    )
+    analytics_parser.add_argument("--format", choices=["table", "json"], default="table")
+    analytics_parser.add_argument("--top", type=int, default=10, help="Length of every ranking")
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help="Compare two graphs and list the direct dependencies of --pipfile whose pins changed, exits 1 if any did",
+    )
+    diff_parser.add_argument("old_graph")
+    diff_parser.add_argument("new_graph")
+    why_parser = subparsers.add_parser("why", help="Show which direct dependencies pull in a package and how")
+    why_parser.add_argument("package")
+    why_parser.add_argument(
+        "--index",
+        help="Reverse index written by --reverse-index, rebuilt from --pipfile and --pipfile-graph when stale",
+    )
 
     args = parser.parse_args()
+    for emit in args.emit:
+        if emit.partition("=")[0] not in EMITTERS or "=" not in emit:
+            parser.error(f"--emit {emit} is not FORMAT=PATH with FORMAT one of {', '.join(EMITTERS)}")
+    if args.command == "watch" and (args.sort_graph or args.site_packages or args.snapshot or args.profile):
+        parser.error("watch doesn't support --sort-graph, --site-packages, --snapshot or --profile")
+    if args.command == "batch":
+        results = run_batch(
+            find_projects(args.projects, Path(args.manifest) if args.manifest else None),
+            args.jobs,
+            closure_backend=args.closure_backend,
+            output_mode=args.output_mode,
+            target_format=args.target_format,
+            snapshot=args.snapshot,
+            pipfile_lock=args.pipfile_lock,
+        )
+        print(batch_summary(results), file=sys.stderr)
+        sys.exit(1 if any(r["error"] is not None for r in results) else 0)
+    if args.command == "watch":
+        watcher = Watcher(
+            Path(args.pipfile),
+            Path(args.pipfile_graph),
+            Path(args.build_file),
+            closure_backend=args.closure_backend,
+            output_mode=args.output_mode,
+            target_format=args.target_format,
+            pipfile_lock=Path(args.pipfile_lock) if args.pipfile_lock else None,
+            outputs=[(name, Path(path)) for name, path in (e.split("=", 1) for e in args.emit)],
+            reverse_index=Path(args.reverse_index) if args.reverse_index else None,
+        )
+        try:
+            watcher.run(args.interval)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    if args.command == "analytics":
+        report = analyze_graph(
+            DependencyGraph.from_path(Path(args.pipfile_graph), args.closure_backend),
+            read_direct_dependencies(Path(args.pipfile).read_text()),
+            args.top,
+        )
+        print(json.dumps(report, indent=4) if args.format == "json" else format_analytics(report))
+        sys.exit(0)
+    if args.command == "diff":
+        difference = diff_graphs(
+            DependencyGraph.from_path(Path(args.old_graph)),
+            DependencyGraph.from_path(Path(args.new_graph)),
+            read_direct_dependencies(Path(args.pipfile).read_text()),
+        )
+        if str(difference):
+            print(difference)
+        sys.exit(1 if difference.targets else 0)
+    if args.command == "why":
+        source = index_source(Path(args.pipfile), Path(args.pipfile_graph))
+        index = ReverseIndex.load(Path(args.index), source) if args.index else None
+        if index is None:
+            if args.snapshot:
+                graph = DependencyGraph(*GraphSnapshot.next_to(Path(args.pipfile_graph)).index())
+            else:
+                graph = DependencyGraph.from_path(Path(args.pipfile_graph))
+            index = ReverseIndex.from_graph(graph, read_direct_dependencies(Path(args.pipfile).read_text()), source)
+            if args.index:
+                index.save(Path(args.index))
+        print(why(args.package, index))
+        sys.exit(0 if args.package.lower() in index else 1)
+
+    instrumentation = Instrumentation(Path(args.cprofile) if args.cprofile else None) if args.profile else None
+
+    main(
+        Path(args.pipfile),
+        Path(args.pipfile_graph),
+        Path(args.build_file),
+        closure_backend=args.closure_backend,
+        sort_graph=args.sort_graph,
+        site_packages=Path(args.site_packages) if args.site_packages else None,
+        instrumentation=instrumentation,
+        output_mode=args.output_mode,
+        target_format=args.target_format,
+        reverse_index=Path(args.reverse_index) if args.reverse_index else None,
+        snapshot=args.snapshot,
+        outputs=[(name, Path(path)) for name, path in (e.split("=", 1) for e in args.emit)],
+        pipfile_lock=Path(args.pipfile_lock) if args.pipfile_lock else None,
+    )
 
-    main(Path(args.pipfile), Path(args.pipfile_graph), Path(args.build_file))
+    if instrumentation is not None:
+        print(instrumentation.report(args.profile), file=sys.stderr)
@@ -1,20 +1,13 @@
 #!/usr/bin/env python3
 
-import json
 import sys
-from typing import Any, Dict, List
+from pathlib import Path
+
+from pipenv_graph_to_build import sort_graph_file
 
 if len(sys.argv) == 1:
     input_file = "Pipfile.lock.graph"
 else:
     input_file = sys.argv[1]
 
-with open(input_file) as f:
-    input_obj: List[Dict[str, Any]] = json.load(f)
-
-input_obj.sort(key=lambda obj: obj["package"]["key"])
-for package in input_obj:
-    package["dependencies"].sort(key=lambda obj: obj["key"])
-
-with open(input_file, "w") as f:
-    json.dump(input_obj, f, indent=4)
+sort_graph_file(Path(input_file))
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from .benchmark_pipenv_graph_to_build import SHAPES, find_regressions, synthetic_graph, synthetic_pipfile
+from .pipenv_graph_to_build import DependencyGraph, read_direct_dependencies
+
+
+class TestSyntheticGraph:
+    @pytest.mark.parametrize("shape", sorted(SHAPES))
+    def test_every_shape_resolves(self, shape: str) -> None:
+        packages = synthetic_graph(shape, 50)
+
+        graph = DependencyGraph.from_json(json.dumps(packages))
+
+        assert len(graph) == 50
+        assert len(list(graph.dependencies())) == 50
+
+    def test_chain_reaches_every_package_from_the_head(self) -> None:
+        graph = DependencyGraph.from_json(json.dumps(synthetic_graph("chain", 30)))
+
+        assert len(graph.resolve("package-00000").dependencies) == 29
+
+    def test_cycles_shape_contains_cycles(self) -> None:
+        graph = DependencyGraph.from_json(json.dumps(synthetic_graph("cycles", 30)))
+
+        list(graph.dependencies())
+
+        assert len(graph.cycles) == 3
+
+    def test_pipfile_declares_the_requested_number_of_direct_dependencies(self) -> None:
+        pipfile = synthetic_pipfile(synthetic_graph("forest", 400), direct=40)
+
+        assert len(read_direct_dependencies(pipfile)) == 40
+
+
+class TestFindRegressions:
+    def test_reports_only_measurements_above_the_threshold(self) -> None:
+        baseline = {"chain:10": {"main": {"seconds": 1.0, "peak_bytes": 100}}}
+        results = {"chain:10": {"main": {"seconds": 1.2, "peak_bytes": 200}}, "new:10": {"main": {"seconds": 9.0}}}
+
+        assert find_regressions(baseline, results, threshold=0.25) == [
+            "chain:10 main peak_bytes: 200 is 100% above 100"
+        ]
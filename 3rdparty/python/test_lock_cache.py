@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from py import path
+
+from .lock_cache import cache_key, restore, store, verify
+
+
+def _workspace(tmpdir: path.local) -> Path:
+    directory = Path(str(tmpdir))
+    (directory / "Pipfile").write_text('[packages]\nrequests = "*"\n')
+    (directory / "Pipfile.lock").write_text("{}")
+    (directory / "Pipfile.lock.graph").write_text("[]")
+    (directory / "BUILD").write_text("# Generated\n")
+    return directory
+
+
+class TestLockCache:
+    def test_restores_outputs_when_inputs_are_unchanged(self, tmpdir: path.local) -> None:
+        directory = _workspace(tmpdir)
+        cache_directory = directory / "cache"
+        store(directory, cache_directory, [cache_key(directory)])
+        (directory / "BUILD").unlink()
+
+        assert restore(directory, cache_directory, cache_key(directory))
+        assert (directory / "BUILD").read_text() == "# Generated\n"
+
+    def test_misses_when_the_pipfile_changes(self, tmpdir: path.local) -> None:
+        directory = _workspace(tmpdir)
+        cache_directory = directory / "cache"
+        store(directory, cache_directory, [cache_key(directory)])
+        (directory / "Pipfile").write_text('[packages]\nrequests = "==2.22.0"\n')
+
+        assert not restore(directory, cache_directory, cache_key(directory))
+
+    def test_verify_reports_corrupted_entries(self, tmpdir: path.local) -> None:
+        directory = _workspace(tmpdir)
+        cache_directory = directory / "cache"
+        key = cache_key(directory)
+        (entry,) = store(directory, cache_directory, [key])
+
+        assert verify(directory, cache_directory, key) == []
+
+        (entry / "BUILD").write_text("# Tampered\n")
+
+        assert verify(directory, cache_directory, key) == [f"{key}: BUILD does not match its manifest"]
+        assert not restore(directory, cache_directory, key)
@@ -1,17 +1,47 @@
 import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
 import textwrap
+import tracemalloc
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional
 
+import pytest
 from attr import Factory, asdict, attrib, attrs
 from py import path
 
 from .pipenv_graph_to_build import (
+    BITSET_THRESHOLD,
+    HEADER,
+    SHARDS_MANIFEST,
+    ClosureCache,
     Dependency,
+    DependencyGraph,
+    GraphSnapshot,
+    Instrumentation,
+    ReverseIndex,
+    SetClosureBackend,
+    Watcher,
+    analyze_graph,
+    batch_summary,
+    collect_graph,
     create_build_file,
+    create_closure_backend,
+    create_shared_build_file,
+    diff_graphs,
+    find_projects,
+    format_analytics,
+    index_source,
     main,
     read_dependencies,
     read_direct_dependencies,
+    run_batch,
+    why,
+    write_shards,
+    write_if_changed,
 )
 
 
@@ -269,6 +299,514 @@ class TestReadDependencies:
             ),
         ]
 
+    def test_resolves_shared_subtrees_only_once(self) -> None:
+        """Every layer depends on both packages of the next layer so the
+        number of paths doubles per layer, walking each path would never finish
+        """
+        layers = 64
+        input_dependencies = []
+        for layer in range(layers):
+            for side in ("left", "right"):
+                next_layer = (
+                    [_package(f"{s}-{layer + 1}", "1.0.0") for s in ("left", "right")]
+                    if layer + 1 < layers
+                    else []
+                )
+                input_dependencies.append(_dependency(f"{side}-{layer}", "1.0.0", next_layer))
+
+        returned_dependencies = {d.key: d for d in self._read(input_dependencies)}
+
+        assert len(returned_dependencies["left-0"].dependencies) == 2 * (layers - 1)
+        assert returned_dependencies["left-0"].dependencies == returned_dependencies["right-0"].dependencies
+
+    def test_members_of_a_cycle_share_the_same_closure(self, caplog) -> None:
+        input_dependencies = [
+            _dependency("first", "1.0.0", [_package("second", "2.0.0")]),
+            _dependency("second", "2.0.0", [_package("first", "1.0.0"), _package("leaf", "0.1.0")]),
+            _dependency("leaf", "0.1.0"),
+        ]
+
+        returned_dependencies = self._read(input_dependencies)
+
+        assert returned_dependencies == [
+            Dependency(
+                "first",
+                "first",
+                "1.0.0",
+                dependencies=[Dependency("leaf", "leaf", "0.1.0"), Dependency("second", "second", "2.0.0")],
+            ),
+            Dependency("leaf", "leaf", "0.1.0"),
+            Dependency(
+                "second",
+                "second",
+                "2.0.0",
+                dependencies=[Dependency("first", "first", "1.0.0"), Dependency("leaf", "leaf", "0.1.0")],
+            ),
+        ]
+        assert "Dependency cycle between first, second" in caplog.text
+
+    def test_resolves_chains_deeper_than_the_recursion_limit(self) -> None:
+        depth = sys.getrecursionlimit() * 2
+        input_dependencies = [
+            _dependency(f"package-{i:05}", "1.0.0", [_package(f"package-{i + 1:05}", "1.0.0")])
+            for i in range(depth)
+        ]
+
+        returned_dependencies = self._read(input_dependencies)
+
+        assert len(returned_dependencies[0].dependencies) == depth
+
+
+@pytest.fixture
+def combine_calls(monkeypatch) -> List[int]:
+    """Records the size of every graph the set backend combines a closure for"""
+    calls: List[int] = []
+    combine = SetClosureBackend.combine
+
+    def counting_combine(self: SetClosureBackend, *args, **kwargs):
+        calls.append(self.size)
+        return combine(self, *args, **kwargs)
+
+    monkeypatch.setattr(SetClosureBackend, "combine", counting_combine)
+    return calls
+
+
+class TestDependencyGraph:
+    def _graph(self, input_dependencies) -> DependencyGraph:
+        return DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))))
+
+    def test_only_resolves_what_is_reachable_from_requested_keys(self) -> None:
+        graph = self._graph(
+            [
+                _dependency("wanted", "1.0.0", [_package("subdependency", "0.1.0")]),
+                _dependency("subdependency", "0.1.0"),
+                _dependency("unwanted", "2.0.0", [_package("unwanted-subdependency", "0.2.0")]),
+                _dependency("unwanted-subdependency", "0.2.0"),
+            ]
+        )
+
+        returned_dependencies = list(graph.dependencies(["wanted", "not-in-graph"]))
+
+        assert returned_dependencies == [
+            Dependency(
+                "wanted", "wanted", "1.0.0", dependencies=[Dependency("subdependency", "subdependency", "0.1.0")]
+            )
+        ]
+        assert graph.resolved_count == 2
+
+    def test_caches_resolved_dependencies(self) -> None:
+        graph = self._graph([_dependency("only-dependency", "1.0.0")])
+
+        assert graph.resolve("only-dependency") is graph.resolve("only-dependency")
+
+    def test_closures_share_one_node_per_package(self) -> None:
+        roots, leaves = 200, 300
+        graph = self._graph(
+            [
+                _dependency(f"root-{i}", "1.0.0", [_package(f"leaf-{j}", "1.0.0") for j in range(leaves)])
+                for i in range(roots)
+            ]
+            + [_dependency(f"leaf-{j}", "1.0.0") for j in range(leaves)]
+        )
+        graph = DependencyGraph(graph.nodes, graph.edges, backend="bitset")
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            resolved = list(graph.dependencies())
+            allocated = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+        closure_edges = sum(len(d.dependencies) for d in resolved)
+        assert closure_edges == roots * leaves
+        assert len({id(d) for r in resolved for d in r.dependencies}) == leaves
+        assert allocated < 12 * closure_edges + 512 * len(graph)
+
+    def test_reads_graph_file_as_a_stream(self, tmpdir: path.local) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        input_dependencies = [
+            _dependency("top-dependency", "2.0.0", [_package("Subdependency", "0.1.0")]),
+            _dependency("subdependency", "0.1.0", [_package("setuptools", "41.0.0")]),
+        ]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies)), indent=4))
+
+        graph = DependencyGraph.from_path(pipfile_graph)
+
+        assert list(graph.dependencies()) == list(self._graph(input_dependencies).dependencies())
+
+    def test_streaming_peak_memory_tracks_the_graph_not_the_document(self, tmpdir: path.local) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        size = 2000
+        pipfile_graph.write_text(
+            json.dumps(
+                [
+                    asdict(
+                        _dependency(
+                            f"package-{i}",
+                            "1.0.0",
+                            [_package(f"package-{j}", "1.0.0") for j in range(i + 1, min(size, i + 6))],
+                        )
+                    )
+                    for i in range(size)
+                ],
+                indent=4,
+            )
+        )
+
+        def peak(f) -> int:
+            tracemalloc.start()
+            try:
+                f()
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        streamed = peak(lambda: DependencyGraph.from_path(pipfile_graph))
+        loaded = peak(lambda: DependencyGraph.from_json(pipfile_graph.read_text()))
+
+        assert streamed < loaded / 2
+
+    def test_reuses_closures_from_other_graphs_with_the_same_subgraph(self, combine_calls: List[int]) -> None:
+        cache = ClosureCache()
+
+        def graph_json(top: str, leaf_version: str = "0.1.0") -> str:
+            input_dependencies = [
+                _dependency(top, "1.0.0", [_package("middle", "1.0.0")]),
+                _dependency("middle", "1.0.0", [_package("leaf", leaf_version)]),
+                _dependency("leaf", leaf_version),
+            ]
+            return json.dumps(list(map(asdict, input_dependencies)))
+
+        uncached = list(read_dependencies(graph_json("first")))
+        combine_calls.clear()
+
+        first = DependencyGraph.from_json(graph_json("first"), closure_cache=cache)
+        assert list(first.dependencies()) == uncached
+        assert (cache.hits, cache.misses, len(combine_calls)) == (0, 3, 3)
+
+        second = DependencyGraph.from_json(graph_json("second"), closure_cache=cache)
+        assert second.resolve("middle") is first.resolve("middle")
+        assert second.closure_size("middle") == 1
+        assert (cache.hits, cache.misses, len(combine_calls)) == (2, 3, 3)
+
+        assert [d.key for d in second.resolve("second").dependencies] == ["leaf", "middle"]
+        assert (cache.hits, cache.misses, len(combine_calls)) == (2, 4, 5)
+
+        changed = DependencyGraph.from_json(graph_json("third", "0.2.0"), closure_cache=cache)
+        assert [d.installed_version for d in changed.resolve("middle").dependencies] == ["0.2.0"]
+        assert (cache.hits, cache.misses, len(combine_calls)) == (2, 6, 7)
+
+
+class TestClosureBackends:
+    @pytest.mark.parametrize("backend", ["set", "bitset", "numpy"])
+    def test_all_backends_resolve_the_same_closures(self, backend: str) -> None:
+        if backend == "numpy":
+            pytest.importorskip("numpy")
+        input_dependencies = [
+            _dependency("top", "1.0.0", [_package("cycle-a", "0.1.0"), _package("leaf", "0.3.0")]),
+            _dependency("cycle-a", "0.1.0", [_package("cycle-b", "0.2.0")]),
+            _dependency("cycle-b", "0.2.0", [_package("cycle-a", "0.1.0"), _package("leaf", "0.3.0")]),
+            _dependency("leaf", "0.3.0"),
+        ]
+        json_string = json.dumps(list(map(asdict, input_dependencies)))
+
+        returned_dependencies = list(read_dependencies(json_string, backend=backend))
+
+        assert returned_dependencies == list(read_dependencies(json_string, backend="set"))
+        assert [d.key for d in returned_dependencies[-1].dependencies] == ["cycle-a", "cycle-b", "leaf"]
+
+    def test_picks_backend_by_graph_size(self) -> None:
+        assert create_closure_backend("auto", 10).name == "set"
+        assert create_closure_backend("auto", BITSET_THRESHOLD).name == "bitset"
+
+    def test_rejects_unknown_backend(self) -> None:
+        with pytest.raises(ValueError):
+            create_closure_backend("abacus", 10)
+
+
+class TestReverseIndex:
+    def _index(self) -> ReverseIndex:
+        input_dependencies = [
+            _dependency("top", "1.0.0", [_package("middle", "0.1.0"), _package("cycle-a", "0.2.0")]),
+            _dependency("middle", "0.1.0", [_package("regex", "2019.8.19")]),
+            _dependency("cycle-a", "0.2.0", [_package("cycle-b", "0.3.0")]),
+            _dependency("cycle-b", "0.3.0", [_package("cycle-a", "0.2.0"), _package("regex", "2019.8.19")]),
+            _dependency("black", "19.3b0", [_package("regex", "2019.8.19")]),
+            _dependency("regex", "2019.8.19"),
+            _dependency("unused", "1.0.0"),
+        ]
+        graph = DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))))
+        return ReverseIndex.from_graph(graph, ["top", "black", "not-installed"], source="abc")
+
+    def test_finds_direct_dependencies_pulling_in_a_package(self) -> None:
+        index = self._index()
+
+        assert index.pulled_in_by("regex") == ["black", "top"]
+        assert index.pulled_in_by("cycle-b") == ["top"]
+        assert index.pulled_in_by("unused") == []
+        assert index.required_by["regex"] == ["black", "cycle-b", "middle"]
+
+    def test_finds_shortest_paths(self) -> None:
+        index = self._index()
+
+        assert index.path("top", "regex") == ["top", "middle", "regex"]
+        assert index.path("top", "cycle-b") == ["top", "cycle-a", "cycle-b"]
+        assert index.shortest_path("regex") == ["black", "regex"]
+        assert index.shortest_path("unused") is None
+
+    def test_explains_why_a_package_is_included(self) -> None:
+        index = self._index()
+
+        assert why("Regex", index).splitlines() == [
+            "regex is required by black, cycle-b, middle",
+            "pulled in by black: black -> regex",
+            "pulled in by top: top -> middle -> regex",
+        ]
+        assert why("unused", index).splitlines() == [
+            "unused is required by nothing",
+            "no direct dependency pulls it in",
+        ]
+        assert why("missing", index) == "missing is not in the graph"
+
+    def test_loads_a_saved_index_only_for_the_same_source(self, tmpdir: path.local) -> None:
+        index_file = Path(str(tmpdir)) / "index.json"
+        self._index().save(index_file)
+
+        loaded = ReverseIndex.load(index_file, source="abc")
+
+        assert loaded is not None
+        assert loaded.path("top", "regex") == ["top", "middle", "regex"]
+        assert ReverseIndex.load(index_file, source="def") is None
+        assert ReverseIndex.load(index_file.with_name("missing.json"), source="abc") is None
+
+
+class TestGraphSnapshot:
+    def _write_graph(self, pipfile_graph: Path, leaf_version: str = "0.1.0") -> None:
+        input_dependencies = [
+            _dependency("top", "1.0.0", [_package("leaf", leaf_version), _package("cycle", "0.2.0")]),
+            _dependency("cycle", "0.2.0", [_package("top", "1.0.0")]),
+            _dependency("leaf", leaf_version, package_name="Leaf"),
+        ]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+    def _index(self, pipfile_graph: Path) -> GraphSnapshot:
+        snapshot = GraphSnapshot.next_to(pipfile_graph)
+        graph = DependencyGraph.from_path(pipfile_graph)
+        assert snapshot.index() == (graph.nodes, graph.edges)
+        return snapshot
+
+    def test_loads_the_same_graph_until_it_changes(self, tmpdir: path.local) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        self._write_graph(pipfile_graph)
+
+        assert not self._index(pipfile_graph).hit
+        assert self._index(pipfile_graph).hit
+        os.utime(str(pipfile_graph), ns=(0, 0))
+        assert self._index(pipfile_graph).hit, "same content with another mtime should still hit"
+        self._write_graph(pipfile_graph, "0.3.0")
+        assert not self._index(pipfile_graph).hit
+        assert self._index(pipfile_graph).hit
+
+    def test_records_the_new_mtime_after_a_content_hash_hit(self, tmpdir: path.local, monkeypatch) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        self._write_graph(pipfile_graph)
+        self._index(pipfile_graph)
+        os.utime(str(pipfile_graph), ns=(0, 0))
+        snapshot = self._index(pipfile_graph)
+        assert snapshot.hit
+        # on filesystems with coarse timestamps the next load could otherwise fall in the same clock tick
+        written_ns = snapshot.path.stat().st_mtime_ns + 10 ** 9
+        os.utime(str(snapshot.path), ns=(written_ns, written_ns))
+
+        def no_hashing(path: Path) -> str:
+            raise AssertionError(f"{path} was hashed again")
+
+        monkeypatch.setattr(f"{GraphSnapshot.__module__}._file_digest", no_hashing)
+        assert self._index(pipfile_graph).hit
+
+    def test_misses_a_rewrite_that_keeps_the_size_and_mtime(self, tmpdir: path.local) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        self._write_graph(pipfile_graph, "0.1.0")
+        self._index(pipfile_graph)
+        before = pipfile_graph.stat()
+
+        self._write_graph(pipfile_graph, "0.2.0")
+        os.utime(str(pipfile_graph), ns=(before.st_atime_ns, before.st_mtime_ns))
+
+        assert pipfile_graph.stat().st_size == before.st_size
+        assert not self._index(pipfile_graph).hit
+
+    def test_ignores_corrupt_snapshots_and_other_versions(self, tmpdir: path.local, monkeypatch) -> None:
+        pipfile_graph = Path(str(tmpdir)) / "Pipfile.lock.graph"
+        self._write_graph(pipfile_graph)
+        snapshot = self._index(pipfile_graph)
+        snapshot.path.write_bytes(snapshot.path.read_bytes()[:-3])
+
+        assert not self._index(pipfile_graph).hit
+        monkeypatch.setattr(GraphSnapshot, "version", GraphSnapshot.version + 1)
+        assert not self._index(pipfile_graph).hit
+        assert self._index(pipfile_graph).hit
+
+
+class TestDiffGraphs:
+    def _graph(self, input_dependencies) -> DependencyGraph:
+        return DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))))
+
+    def test_reports_packages_and_direct_dependencies_that_changed(self) -> None:
+        old = self._graph(
+            [
+                _dependency("black", "19.3b0", [_package("regex", "2019.8.19"), _package("click", "7.0")]),
+                _dependency("requests", "2.22.0", [_package("idna", "2.8")]),
+                _dependency("flask", "1.1.1", [_package("click", "7.0")]),
+                _dependency("regex", "2019.8.19"),
+                _dependency("click", "7.0"),
+                _dependency("idna", "2.8"),
+                _dependency("six", "1.12.0"),
+            ]
+        )
+        new = self._graph(
+            [
+                _dependency("black", "19.3b0", [_package("regex", "2020.1.8"), _package("click", "7.0")]),
+                _dependency("requests", "2.22.0", [_package("idna", "2.8"), _package("urllib3", "1.25.7")]),
+                _dependency("flask", "1.1.1", [_package("click", "7.0")]),
+                _dependency("regex", "2020.1.8"),
+                _dependency("click", "7.0"),
+                _dependency("idna", "2.8"),
+                _dependency("urllib3", "1.25.7"),
+            ]
+        )
+
+        difference = diff_graphs(old, new, ["black", "flask", "requests"])
+
+        assert [d.key for d in difference.added] == ["urllib3"]
+        assert [d.key for d in difference.removed] == ["six"]
+        assert [(a.installed_version, b.installed_version) for a, b in difference.changed] == [
+            ("2019.8.19", "2020.1.8")
+        ]
+        assert difference.targets == ["black", "requests"]
+        assert str(difference).splitlines() == [
+            "added urllib3 1.25.7",
+            "removed six 1.12.0",
+            "changed regex 2019.8.19 -> 2020.1.8",
+            "closure changed black",
+            "closure changed requests",
+        ]
+
+    def test_ignores_new_requirements_on_packages_already_in_the_closure(self) -> None:
+        old = self._graph(
+            [
+                _dependency("top", "1.0.0", [_package("middle", "0.1.0"), _package("leaf", "0.2.0")]),
+                _dependency("middle", "0.1.0"),
+                _dependency("leaf", "0.2.0"),
+            ]
+        )
+        new = self._graph(
+            [
+                _dependency("top", "1.0.0", [_package("middle", "0.1.0"), _package("leaf", "0.2.0")]),
+                _dependency("middle", "0.1.0", [_package("leaf", "0.2.0")]),
+                _dependency("leaf", "0.2.0"),
+            ]
+        )
+
+        difference = diff_graphs(old, new, ["top"])
+
+        assert (difference.added, difference.removed, difference.changed, difference.targets) == ([], [], [], [])
+
+
+class TestAnalyzeGraph:
+    @pytest.mark.parametrize("backend", ["set", "bitset", "numpy"])
+    def test_measures_every_package_on_the_condensed_graph(self, backend: str) -> None:
+        if backend == "numpy":
+            pytest.importorskip("numpy")
+        input_dependencies = [
+            _dependency("top", "1.0.0", [_package("cycle-a", "0.1.0"), _package("leaf", "0.3.0")]),
+            _dependency("cycle-a", "0.1.0", [_package("cycle-b", "0.2.0")]),
+            _dependency("cycle-b", "0.2.0", [_package("cycle-a", "0.1.0"), _package("leaf", "0.3.0")]),
+            _dependency("other", "2.0.0", [_package("leaf", "0.3.0")]),
+            _dependency("leaf", "0.3.0"),
+        ]
+        graph = DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))), backend=backend)
+
+        report = analyze_graph(graph, ["top", "other", "missing"], top=2)
+
+        assert report["packages"]["top"] == dict(fan_in=0, fan_out=2, closure_size=3, depth=2, targets=1)
+        assert report["packages"]["cycle-a"] == dict(fan_in=2, fan_out=1, closure_size=2, depth=1, targets=1)
+        assert report["packages"]["leaf"] == dict(fan_in=3, fan_out=0, closure_size=0, depth=0, targets=2)
+        assert report["summary"] == dict(nodes=5, edges=6, cycles=1, direct_dependencies=2, max_depth=2)
+        assert report["closure_size_histogram"] == {"0": 1, "1": 1, "2-3": 3}
+        assert report["heaviest_targets"] == [
+            dict(package="top", closure_size=3),
+            dict(package="other", closure_size=1),
+        ]
+        assert report["most_pinned"] == [dict(package="leaf", targets=2), dict(package="cycle-a", targets=1)]
+
+    def test_formats_the_report_as_tables(self) -> None:
+        input_dependencies = [_dependency("top", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        graph = DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))))
+
+        table = format_analytics(analyze_graph(graph, ["top"]))
+
+        assert re.search(r"^heaviest targets +closure_size$", table, re.MULTILINE)
+        assert re.search(r"^top +1$", table, re.MULTILINE)
+
+
+class TestCollectGraph:
+    def _install(self, site_packages: Path, name: str, version: str, requires: List[str] = ()) -> None:
+        dist_info = site_packages / f"{name.replace('-', '_')}-{version}.dist-info"
+        dist_info.mkdir(parents=True)
+        (dist_info / "METADATA").write_text(
+            "\n".join(
+                ["Metadata-Version: 2.1", f"Name: {name}", f"Version: {version}"]
+                + [f"Requires-Dist: {r}" for r in requires]
+            )
+            + "\n"
+        )
+
+    def test_collects_graph_from_a_virtualenv(self, tmpdir: path.local) -> None:
+        venv = Path(str(tmpdir))
+        site_packages = venv / "lib" / "python3.6" / "site-packages"
+        self._install(site_packages, "Top-Dependency", "2.0.0.post1", ["sub_dependency (>=0.1)", "missing"])
+        self._install(site_packages, "sub_dependency", "0.1.0", ['optional ; extra == "fast"'])
+        self._install(site_packages, "optional", "1.0.0")
+
+        packages = collect_graph(venv)
+
+        assert sorted(packages, key=lambda p: p["package"]["key"]) == [
+            dict(package=dict(key="optional", package_name="optional", installed_version="1.0.0"), dependencies=[]),
+            dict(
+                package=dict(key="sub-dependency", package_name="sub_dependency", installed_version="0.1.0"),
+                dependencies=[],
+            ),
+            dict(
+                package=dict(key="top-dependency", package_name="Top-Dependency", installed_version="2.0.0.post1"),
+                dependencies=[
+                    dict(
+                        key="sub-dependency",
+                        package_name="sub_dependency",
+                        installed_version="0.1.0",
+                        required_version=">=0.1",
+                    )
+                ],
+            ),
+        ]
+
+    def test_main_writes_collected_graph_and_build(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        site_packages = tmp_path / "site-packages"
+        self._install(site_packages, "top-dependency", "2.0.0.post1", ["subdependency"])
+        self._install(site_packages, "subdependency", "0.1.0")
+        pipfile = tmp_path / "Pipfile"
+        pipfile.write_text("[packages]\ntop-dependency = \"*\"\n")
+
+        main(pipfile, tmp_path / "Pipfile.lock.graph", tmp_path / "BUILD", site_packages=site_packages)
+
+        assert [d.key for d in read_dependencies((tmp_path / "Pipfile.lock.graph").read_text())] == [
+            "subdependency",
+            "top-dependency",
+        ]
+        assert 'python_requirement("top-dependency==2.0.0.post1"),' in (tmp_path / "BUILD").read_text()
+
 
 class TestReadDirectDependenciesFromPipfile:
     def test_parses_out_all_packages(self) -> None:
@@ -360,6 +898,56 @@ class TestReadDirectDependenciesFromPipfile:
 
         assert direct_dependencies == ["pymysql"]
 
+    def test_reads_quoted_keys_inline_tables_and_comments(self) -> None:
+        pipfile = (
+            # language=toml
+            """
+            [packages]
+            # pinned until the next release
+            "zope.interface" = "*"
+            requests = {version = "*", extras = ["security"]}  # comment
+            'Django' = ">=2.2"
+
+            [requires]
+            python_version = "3.6"
+            """
+        )
+
+        direct_dependencies = read_direct_dependencies(pipfile)
+
+        assert direct_dependencies == ["django", "requests", "zope.interface"]
+
+    @pytest.mark.parametrize(
+        "pipfile,expected",
+        [
+            ('[packages.requests]\nversion = "*"\n\n[packages]\nattrs = "*"\n', ["attrs", "requests"]),
+            ('[scripts]\nlint = """\n[packages]\nnot-a-package = "*"\n"""\n\n[packages]\nattrs = "*"\n', ["attrs"]),
+            ('[packages]\nattrs = {version = "*", extras = [\n    "tests",\n]}\n', ["attrs"]),
+        ],
+    )
+    def test_falls_back_to_a_toml_parser_for_anything_unusual(self, pipfile: str, expected: List[str]) -> None:
+        direct_dependencies = read_direct_dependencies(pipfile)
+
+        assert direct_dependencies == expected
+
+    def test_does_not_import_a_toml_parser_for_a_plain_pipfile(self) -> None:
+        code = (
+            "import sys\n"
+            "from pipenv_graph_to_build import read_direct_dependencies\n"
+            "assert read_direct_dependencies('[packages]\\nattrs = \"*\"\\n') == ['attrs']\n"
+            "print(sorted({'toml', 'tomllib'} & set(sys.modules)))\n"
+        )
+
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=str(Path(__file__).parent),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout
+
+        assert output == "[]\n"
+
 
 class TestCreateBuildFile:
     def test_creates_a_build_file_containing_direct_dependencies(self) -> None:
@@ -489,6 +1077,377 @@ class TestCreateBuildFile:
         )
 
 
+class TestCreateSharedBuildFile:
+    all_dependencies = [
+        Dependency("attrs", "attrs", "18.1.0"),
+        Dependency("second-level-dependency", "second-level-dependency", "0.2.0"),
+        Dependency(
+            "top-dependency",
+            "top_dependency",
+            "1.0.0",
+            dependencies=[
+                Dependency("attrs", "attrs", "18.1.0"),
+                Dependency("second-level-dependency", "second-level-dependency", "0.2.0"),
+            ],
+        ),
+    ]
+
+    def test_writes_every_pin_once(self) -> None:
+        build_string = create_shared_build_file(self.all_dependencies, ["attrs", "top-dependency"])
+
+        assert build_string == textwrap.dedent(
+            # language=python
+            """
+            target(
+                name="attrs",
+                dependencies=[
+                    ":pinned-attrs",
+                ],
+            )
+            
+            
+            target(
+                name="top_dependency",
+                dependencies=[
+                    ":pinned-top_dependency",
+                    ":pinned-attrs",
+                    ":pinned-second-level-dependency",
+                ],
+            )
+            
+            
+            python_requirement_library(
+                name="pinned-attrs",
+                requirements=[
+                    python_requirement("attrs==18.1.0"),
+                ],
+            )
+            
+            
+            python_requirement_library(
+                name="pinned-second-level-dependency",
+                requirements=[
+                    python_requirement("second-level-dependency==0.2.0"),
+                ],
+            )
+            
+            
+            python_requirement_library(
+                name="pinned-top_dependency",
+                requirements=[
+                    python_requirement("top_dependency==1.0.0"),
+                ],
+            )
+            """
+        )
+
+    def test_resolves_to_the_same_pins_as_the_inlined_format(self) -> None:
+        limit_to = ["attrs", "top-dependency"]
+        inlined = create_build_file(self.all_dependencies, limit_to)
+        shared = create_shared_build_file(self.all_dependencies, limit_to)
+
+        def pins_per_target(build_string: str) -> Dict[str, List[str]]:
+            targets = {}
+            for block in build_string.strip().split("\n\n\n"):
+                name = re.search(r'name="([^"]+)"', block).group(1)
+                targets[name] = re.findall(r'python_requirement\("([^"]+)"\)', block) + re.findall(
+                    r'":([^"]+)"', block
+                )
+            return targets
+
+        shared_targets = pins_per_target(shared)
+        resolved = {
+            name: sorted(pin for ref in refs for pin in shared_targets[ref])
+            for name, refs in shared_targets.items()
+            if not name.startswith("pinned-")
+        }
+        assert resolved == {name: sorted(pins) for name, pins in pins_per_target(inlined).items()}
+
+
+class TestGoldenBuildFiles:
+    golden = Path(__file__).parent / "testdata" / "golden"
+
+    @pytest.mark.parametrize("output_mode", ["inline", "shared"])
+    @pytest.mark.parametrize("target_format", ["v1", "v2"])
+    def test_matches_golden_build_file(self, tmpdir: path.local, output_mode: str, target_format: str) -> None:
+        build_file = Path(str(tmpdir)) / "BUILD"
+
+        main(
+            self.golden / "Pipfile",
+            self.golden / "Pipfile.lock.graph",
+            build_file,
+            output_mode=output_mode,
+            target_format=target_format,
+        )
+
+        assert build_file.read_text() == (self.golden / f"{output_mode}-{target_format}.BUILD").read_text()
+
+    @pytest.mark.parametrize("emitter,golden_file", [("constraints", "constraints.txt"), ("manifest", "manifest.json")])
+    def test_matches_golden_outputs_from_the_same_run(self, tmpdir: path.local, emitter: str, golden_file: str) -> None:
+        tmp_path = Path(str(tmpdir))
+        instrumentation = Instrumentation()
+
+        main(
+            self.golden / "Pipfile",
+            self.golden / "Pipfile.lock.graph",
+            tmp_path / "BUILD",
+            instrumentation=instrumentation,
+            outputs=[(emitter, tmp_path / golden_file)],
+        )
+
+        assert (tmp_path / golden_file).read_text() == (self.golden / golden_file).read_text()
+        assert (tmp_path / "BUILD").read_text() == (self.golden / "inline-v1.BUILD").read_text()
+        assert f"emit_{emitter}" in instrumentation.stages
+
+    @pytest.mark.parametrize("output_mode,golden_file", [("shared", "shared-v2.BUILD"), ("sharded", "inline-v2.BUILD")])
+    def test_emitted_build_follows_output_mode_and_target_format(
+        self, tmpdir: path.local, output_mode: str, golden_file: str
+    ) -> None:
+        tmp_path = Path(str(tmpdir))
+
+        main(
+            self.golden / "Pipfile",
+            self.golden / "Pipfile.lock.graph",
+            tmp_path / "BUILD",
+            output_mode=output_mode,
+            target_format="v2",
+            outputs=[("build", tmp_path / "emitted.BUILD")],
+        )
+
+        assert (tmp_path / "emitted.BUILD").read_text() == (self.golden / golden_file).read_text()
+
+
+class TestWriteIfChanged:
+    def test_replaces_file_with_streamed_content(self, tmpdir: path.local) -> None:
+        build_file = Path(str(tmpdir)) / "BUILD"
+        build_file.write_text("old")
+
+        assert write_if_changed(build_file, iter(["new ", "content"]))
+        assert build_file.read_text() == "new content"
+        assert os.listdir(str(tmpdir)) == ["BUILD"]
+
+    def test_leaves_file_untouched_when_content_is_the_same(self, tmpdir: path.local) -> None:
+        build_file = Path(str(tmpdir)) / "BUILD"
+        build_file.write_text("same content")
+        inode = build_file.stat().st_ino
+
+        assert not write_if_changed(build_file, iter(["same ", "content"]))
+        assert build_file.stat().st_ino == inode
+        assert os.listdir(str(tmpdir)) == ["BUILD"]
+
+    def test_keeps_the_old_file_when_rendering_fails_halfway(self, tmpdir: path.local) -> None:
+        build_file = Path(str(tmpdir)) / "BUILD"
+        build_file.write_text("old")
+
+        def chunks() -> Iterator[str]:
+            yield "half of the"
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            write_if_changed(build_file, chunks())
+
+        assert build_file.read_text() == "old"
+        assert os.listdir(str(tmpdir)) == ["BUILD"]
+
+
+class TestWatcher:
+    def _write_graph(self, pipfile_graph: Path, leaf_version: str) -> None:
+        input_dependencies = [
+            _dependency("first", "1.0.0", [_package("leaf", leaf_version)]),
+            _dependency("second", "2.0.0", [_package("shared", "0.3.0")]),
+            _dependency("leaf", leaf_version),
+            _dependency("shared", "0.3.0"),
+        ]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+    def test_regenerates_only_after_changes(self, tmpdir: path.local, combine_calls: List[int]) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        self._write_graph(pipfile_graph, "0.1.0")
+        watcher = Watcher(pipfile, pipfile_graph, build_file)
+
+        assert watcher.poll()
+        assert not watcher.poll()
+        assert 'python_requirement("leaf==0.1.0"),' in build_file.read_text()
+
+        pipfile.write_text("[packages]\nfirst = \"*\"\nsecond = \"*\"\n")
+        assert watcher.poll()
+        assert 'python_requirement("shared==0.3.0"),' in build_file.read_text()
+
+        combine_calls.clear()
+        self._write_graph(pipfile_graph, "0.10.0")
+        assert watcher.poll()
+        assert 'python_requirement("leaf==0.10.0"),' in build_file.read_text()
+        assert len(combine_calls) == 2, "only first and the new leaf should be combined, second comes from the cache"
+
+        combine_calls.clear()
+        build_file.unlink()
+        assert watcher.poll()
+        assert 'python_requirement("leaf==0.10.0"),' in build_file.read_text()
+        assert not combine_calls
+
+    def test_sharded_mode_replaces_the_generated_build_file_like_main(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        self._write_graph(pipfile_graph, "0.1.0")
+        main(pipfile, pipfile_graph, build_file)
+        watcher = Watcher(pipfile, pipfile_graph, build_file, output_mode="sharded")
+
+        assert watcher.poll()
+        assert not build_file.exists()
+        assert 'python_requirement("leaf==0.1.0"),' in (tmp_path / "first" / "BUILD").read_text()
+        assert not watcher.poll()
+
+    def test_pins_the_lock_and_regenerates_when_it_changes(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile_lock = tmp_path / "Pipfile.lock"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        self._write_graph(pipfile_graph, "0.1.0")
+        pipfile_lock.write_text(json.dumps({"default": {"leaf": {"version": "==0.1.0.post1"}}}))
+        watcher = Watcher(pipfile, pipfile_graph, build_file, pipfile_lock=pipfile_lock)
+
+        assert watcher.poll()
+        assert 'python_requirement("leaf==0.1.0.post1"),' in build_file.read_text()
+
+        pipfile_lock.write_text(json.dumps({"default": {"leaf": {"version": "==0.1.0.post2"}}}))
+        assert watcher.poll()
+        assert 'python_requirement("leaf==0.1.0.post2"),' in build_file.read_text()
+
+    def test_keeps_only_the_closures_of_the_current_graph(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile.write_text("[packages]\nfirst = \"*\"\nsecond = \"*\"\n")
+        watcher = Watcher(pipfile, pipfile_graph, tmp_path / "BUILD")
+
+        for leaf_version in ("0.1.0", "0.2.0", "0.3.0"):
+            self._write_graph(pipfile_graph, leaf_version)
+            assert watcher.poll()
+            assert len(watcher.closure_cache) == 4
+
+    def test_writes_every_output_along_with_build(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        self._write_graph(pipfile_graph, "0.1.0")
+        watcher = Watcher(
+            pipfile,
+            pipfile_graph,
+            tmp_path / "BUILD",
+            outputs=[("constraints", tmp_path / "constraints.txt")],
+            reverse_index=tmp_path / "index.json",
+        )
+
+        assert watcher.poll()
+        assert "leaf==0.1.0\n" in (tmp_path / "constraints.txt").read_text()
+        self._write_graph(pipfile_graph, "0.2.0")
+        assert watcher.poll()
+        assert "leaf==0.2.0\n" in (tmp_path / "constraints.txt").read_text()
+        index = ReverseIndex.load(tmp_path / "index.json", index_source(pipfile, pipfile_graph))
+        assert index is not None and index.pulled_in_by("leaf") == ["first"]
+
+    def test_keeps_build_while_the_graph_is_half_written(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        self._write_graph(pipfile_graph, "0.1.0")
+        watcher = Watcher(pipfile, pipfile_graph, build_file)
+        watcher.poll()
+        before = build_file.read_text()
+
+        pipfile_graph.write_text(pipfile_graph.read_text()[:40])
+        assert watcher.poll()
+        assert build_file.read_text() == before
+
+        self._write_graph(pipfile_graph, "0.2.0")
+        assert watcher.poll()
+        assert 'python_requirement("leaf==0.2.0"),' in build_file.read_text()
+
+
+class TestWriteShards:
+    def _resolved(self, leaf: str = "0.1.0", direct: str = "first second") -> List[Dependency]:
+        input_dependencies = [
+            _dependency("first", "1.0.0", [_package("leaf", leaf)]),
+            _dependency("second", "2.0.0"),
+            _dependency("leaf", leaf),
+        ]
+        graph = DependencyGraph.from_json(json.dumps(list(map(asdict, input_dependencies))))
+        return list(graph.dependencies(direct.split()))
+
+    def test_writes_one_shard_per_direct_dependency_and_only_changed_ones(self, tmpdir: path.local) -> None:
+        root = Path(str(tmpdir))
+
+        shards, written, removed = write_shards(self._resolved(), root)
+
+        assert shards == [root / "first" / "BUILD", root / "second" / "BUILD"]
+        assert (written, removed) == (2, 0)
+        expected = HEADER + create_build_file(self._resolved(), ["first"]).lstrip()
+        assert (root / "first" / "BUILD").read_text() == expected
+        assert write_shards(self._resolved(), root)[1:] == (0, 0)
+        assert write_shards(self._resolved(leaf="0.2.0"), root)[1:] == (1, 0)
+
+    def test_removes_only_generated_shards_of_dropped_packages(self, tmpdir: path.local) -> None:
+        root = Path(str(tmpdir))
+        write_shards(self._resolved(), root)
+        (root / "handwritten").mkdir()
+        (root / "handwritten" / "BUILD").write_text("python_library()\n")
+        (root / "second" / "notes.txt").write_text("keep me")
+
+        shards, written, removed = write_shards(self._resolved(direct="first"), root)
+
+        assert (written, removed) == (0, 1)
+        assert not (root / "second" / "BUILD").exists()
+        assert (root / "second" / "notes.txt").exists()
+        assert (root / "handwritten" / "BUILD").exists()
+        write_shards(self._resolved(direct="second"), root)
+        assert not (root / "first").exists()
+
+    def test_leaves_generated_build_files_it_did_not_write(self, tmpdir: path.local) -> None:
+        root = Path(str(tmpdir))
+        (root / "nested-project").mkdir()
+        (root / "nested-project" / "BUILD").write_text(HEADER + "python_requirement_library()\n")
+
+        write_shards(self._resolved(), root)
+        shards, written, removed = write_shards(self._resolved(direct="first"), root)
+
+        assert removed == 1
+        assert (root / "nested-project" / "BUILD").exists()
+        assert list(json.loads((root / SHARDS_MANIFEST).read_text())) == ["first"]
+
+    def test_does_not_touch_unchanged_shards(self, tmpdir: path.local, monkeypatch) -> None:
+        root = Path(str(tmpdir))
+        write_shards(self._resolved(), root)
+        (root / "second" / "BUILD").unlink()
+        temporary_files: List[str] = []
+        mkstemp = tempfile.mkstemp
+
+        def recording_mkstemp(*args, **kwargs):
+            fd, name = mkstemp(*args, **kwargs)
+            temporary_files.append(os.path.basename(name))
+            return fd, name
+
+        monkeypatch.setattr(tempfile, "mkstemp", recording_mkstemp)
+
+        assert write_shards(self._resolved(), root)[1:] == (1, 0)
+        assert len(temporary_files) == 1
+        assert (root / "second" / "BUILD").exists()
+        temporary_files.clear()
+        assert write_shards(self._resolved(), root)[1:] == (0, 0)
+        assert not temporary_files
+
+
 class TestMain:
     def test_create_build_file_from_pipfile_and_graph(self, tmpdir: path.local) -> None:
         tmp_path = Path(str(tmpdir))
@@ -562,3 +1521,223 @@ class TestMain:
             """
             ).lstrip()
         )
+
+    def test_sorts_graph_file_from_the_same_parse(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\ntop-dependency = \"*\"\n")
+        input_dependencies = [
+            _dependency(
+                "top-dependency",
+                "2.0.0",
+                package_name="top_dependency",
+                dependencies=[_package("subdependency", "0.1.0"), _package("attrs", "19.1.0")],
+            ),
+            _dependency("subdependency", "0.1.0"),
+            _dependency("attrs", "19.1.0"),
+        ]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+        main(pipfile, pipfile_graph, build_file, sort_graph=True)
+
+        sorted_graph = json.loads(pipfile_graph.read_text())
+        assert [d["package"]["key"] for d in sorted_graph] == ["attrs", "subdependency", "top-dependency"]
+        assert [d["key"] for d in sorted_graph[-1]["dependencies"]] == ["attrs", "subdependency"]
+        assert pipfile_graph.read_text() == json.dumps(sorted_graph, indent=4)
+        assert 'python_requirement("attrs==19.1.0"),' in build_file.read_text()
+
+    def test_records_stages_and_counters_when_instrumented(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        input_dependencies = [_dependency("first", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+        instrumentation = Instrumentation(cprofile=tmp_path / "resolve.prof")
+
+        main(pipfile, pipfile_graph, tmp_path / "BUILD", instrumentation=instrumentation)
+
+        report = json.loads(instrumentation.report("json"))
+        assert list(report["stages"]) == ["read_graph", "read_pipfile", "resolve", "render_and_write"]
+        assert report["counters"]["nodes"] == 2
+        assert report["counters"]["edges"] == 1
+        assert report["counters"]["closure_size_total"] == 1
+        assert report["counters"]["output_bytes"] == len((tmp_path / "BUILD").read_bytes())
+        assert (tmp_path / "resolve.prof").exists()
+
+    def test_batch_generates_every_project_and_shares_closures(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        projects = [tmp_path / "first", tmp_path / "second"]
+        for project in projects:
+            project.mkdir()
+            (project / "Pipfile").write_text(f"[packages]\n{project.name} = \"*\"\nrequests = \"*\"\n")
+            input_dependencies = [
+                _dependency(project.name, "1.0.0", [_package("requests", "2.22.0")]),
+                _dependency("requests", "2.22.0", [_package("idna", "2.8")]),
+                _dependency("idna", "2.8"),
+            ]
+            (project / "Pipfile.lock.graph").write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+        results = run_batch(projects, jobs=1)
+
+        assert [r["project"] for r in results] == [str(p) for p in projects]
+        assert [r["cache_hits"] for r in results] == [0, 2]
+        for project in projects:
+            build_file = (project / "BUILD").read_text()
+            assert f'python_requirement("{project.name}==1.0.0"),' in build_file
+            assert 'python_requirement("idna==2.8"),' in build_file
+
+    def test_batch_shares_closures_only_within_a_worker(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        projects = [tmp_path / f"project-{i}" for i in range(4)]
+        for project in projects:
+            project.mkdir()
+            (project / "Pipfile").write_text('[packages]\nrequests = "*"\n')
+            input_dependencies = [
+                _dependency("requests", "2.22.0", [_package("idna", "2.8")]),
+                _dependency("idna", "2.8"),
+            ]
+            (project / "Pipfile.lock.graph").write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+        results = run_batch(projects, jobs=2)
+
+        assert [r["project"] for r in results] == [str(p) for p in projects]
+        assert [r["cache_hits"] for r in results] == [0, 0, 2, 2]
+        assert all((p / "BUILD").exists() for p in projects)
+
+    def test_batch_reports_projects_that_fail_and_generates_the_rest(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        projects = [tmp_path / "a", tmp_path / "b", tmp_path / "c"]
+        for project in projects:
+            project.mkdir()
+            (project / "Pipfile").write_text('[packages]\nrequests = "*"\n')
+            (project / "Pipfile.lock.graph").write_text(json.dumps([asdict(_dependency("requests", "2.22.0"))]))
+        (projects[1] / "Pipfile.lock.graph").write_text("[{")
+
+        results = run_batch(projects, jobs=1)
+
+        assert [r["error"] is None for r in results] == [True, False, True]
+        assert (projects[2] / "BUILD").exists()
+        assert f"{projects[1]} failed: " in batch_summary(results)
+
+    def test_finds_only_projects_with_a_pipfile_and_a_graph(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        for name in ("complete", "no-graph"):
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "Pipfile").write_text("[packages]\n")
+        (tmp_path / "complete" / "Pipfile.lock.graph").write_text("[]")
+
+        assert find_projects([str(tmp_path / "*")]) == [tmp_path / "complete"]
+
+    def test_writes_the_reverse_index_next_to_build(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        input_dependencies = [_dependency("first", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+        main(pipfile, pipfile_graph, tmp_path / "BUILD", reverse_index=tmp_path / "index.json")
+
+        index = ReverseIndex.load(tmp_path / "index.json", index_source(pipfile, pipfile_graph))
+        assert index is not None
+        assert index.path("first", "leaf") == ["first", "leaf"]
+
+    def test_loads_the_graph_from_a_snapshot_on_the_next_run(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        input_dependencies = [_dependency("first", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+        main(pipfile, pipfile_graph, tmp_path / "BUILD.plain")
+
+        hits = []
+        for _ in range(2):
+            instrumentation = Instrumentation()
+            main(pipfile, pipfile_graph, tmp_path / "BUILD", instrumentation=instrumentation, snapshot=True)
+            hits.append(json.loads(instrumentation.report("json"))["counters"]["snapshot_hit"])
+
+        assert hits == [False, True]
+        assert (tmp_path / "BUILD").read_text() == (tmp_path / "BUILD.plain").read_text()
+
+    def test_pins_the_versions_of_the_lock(self, tmpdir: path.local, caplog) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        pipfile_lock = tmp_path / "Pipfile.lock"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        input_dependencies = [
+            _dependency("first", "1.0.0", [_package("leaf.post", "0.1", package_name="Leaf.Post")]),
+            _dependency("leaf.post", "0.1", package_name="Leaf.Post"),
+            _dependency("setuptools", "41.4.0"),
+        ]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+        pipfile_lock.write_text(
+            json.dumps(
+                {
+                    "_meta": {"hash": {"sha256": "abc"}},
+                    "default": {
+                        "first": {"version": "==1.0.0"},
+                        "leaf-post": {"version": "==0.1.post1"},
+                        "editable": {"editable": True, "path": "."},
+                    },
+                    "develop": {"pytest": {"version": "==5.2.1"}},
+                }
+            )
+        )
+
+        main(pipfile, pipfile_graph, build_file, pipfile_lock=pipfile_lock)
+
+        assert 'python_requirement("leaf.post==0.1.post1"),' in build_file.read_text()
+        assert [r.getMessage() for r in caplog.records] == [
+            "leaf.post is 0.1 in the graph but 0.1.post1 in the lock",
+            "setuptools 41.4.0 is in the graph but not in the lock",
+            "pytest 5.2.1 is in the lock but not in the graph",
+        ]
+
+    def test_batch_pins_the_lock_of_every_project(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        projects = [tmp_path / "first", tmp_path / "second"]
+        for version, project in enumerate(projects, 1):
+            project.mkdir()
+            (project / "Pipfile").write_text('[packages]\nrequests = "*"\n')
+            (project / "Pipfile.lock.graph").write_text(json.dumps([asdict(_dependency("requests", "2.22.0"))]))
+            (project / "Pipfile.lock").write_text(json.dumps({"default": {"requests": {"version": f"=={version}.0"}}}))
+
+        run_batch(projects, jobs=1, pipfile_lock="Pipfile.lock")
+
+        assert 'python_requirement("requests==1.0")' in (projects[0] / "BUILD").read_text()
+        assert 'python_requirement("requests==2.0")' in (projects[1] / "BUILD").read_text()
+
+    def test_pipfile_without_packages_pins_the_whole_graph(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\n")
+        input_dependencies = [_dependency("first", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+
+        main(pipfile, pipfile_graph, build_file)
+
+        all_dependencies = list(read_dependencies(pipfile_graph.read_text()))
+        assert build_file.read_text() == HEADER + create_build_file(all_dependencies).lstrip()
+
+    def test_sharded_output_replaces_the_generated_build_file(self, tmpdir: path.local) -> None:
+        tmp_path = Path(str(tmpdir))
+        pipfile = tmp_path / "Pipfile"
+        pipfile_graph = tmp_path / "Pipfile.lock.graph"
+        build_file = tmp_path / "BUILD"
+        pipfile.write_text("[packages]\nfirst = \"*\"\n")
+        input_dependencies = [_dependency("first", "1.0.0", [_package("leaf", "0.1.0")]), _dependency("leaf", "0.1.0")]
+        pipfile_graph.write_text(json.dumps(list(map(asdict, input_dependencies))))
+        main(pipfile, pipfile_graph, build_file)
+
+        main(pipfile, pipfile_graph, build_file, output_mode="sharded")
+
+        assert not build_file.exists()
+        assert 'python_requirement("leaf==0.1.0"),' in (tmp_path / "first" / "BUILD").read_text()